@@ -4,10 +4,13 @@ Uses SQL generation with table schema awareness
 """
 
 import os
+import re
+import decimal
 import sys
-from typing import Dict, Any, Optional, List
+import hashlib
+import shelve
+from typing import Dict, Any, Optional, List, Union
 import json
-import yaml
 
 # Fix Windows console encoding
 if sys.platform == 'win32':
@@ -18,165 +21,314 @@ if sys.platform == 'win32':
 import snowflake.connector
 from dotenv import load_dotenv
 
+from cortex_common import (
+    ANALYST_TABLES,
+    SQL_MODELS,
+    RelationshipContext,
+    as_relationship_context,
+    build_sql_context,
+    clean_generated_sql,
+    complete_batch,
+    dumps_json,
+    fetch_frame_records,
+    get_table_schemas,
+    load_relationship_context,
+    race_cortex_complete,
+    snowflake_session,
+)
+
 load_dotenv()
 
+# On-disk cache of SQL that generated and executed successfully, keyed by
+# prompt and schema fingerprint, so repeated questions skip Cortex COMPLETE.
+SQL_CACHE_PATH = ".cortex_sql_cache"
+
+# Generated SQL without its own LIMIT is capped so an unbounded query cannot
+# pull millions of rows into memory; override with CORTEX_MAX_ROWS.
+MAX_RESULT_ROWS = int(os.getenv("CORTEX_MAX_ROWS", "10000"))
+FETCH_BATCH_SIZE = 5000
+
+_QUERY_START_RE = re.compile(r"\s*(?:SELECT|WITH)\b", re.IGNORECASE)
+_TRAILING_LIMIT_RE = re.compile(
+    r"\b(?:LIMIT\s+\d+(?:\s+OFFSET\s+\d+)?|FETCH\s+(?:FIRST|NEXT)\s+\d+\s+ROWS?\s+ONLY)\s*\Z",
+    re.IGNORECASE
+)
+# Comments and whitespace at the end of a query, removed before looking for a LIMIT
+_TRAILING_COMMENTS_RE = re.compile(r"(?:\s|--[^\n]*|/\*(?:(?!\*/).)*\*/)*\Z", re.DOTALL)
+# SELECT TOP n cannot be combined with LIMIT
+_SELECT_TOP_RE = re.compile(r"\bSELECT\s+(?:DISTINCT\s+)?TOP\s+\d+", re.IGNORECASE)
+
+
+def _normalize_token(token: str) -> str:
+    """Lower-case a word and drop a trailing plural 's' for loose matching."""
+    token = token.lower()
+    if len(token) > 3 and token.endswith("s"):
+        token = token[:-1]
+    return token
+
 
-def get_snowflake_connection() -> snowflake.connector.SnowflakeConnection:
-    """Create and return a Snowflake connection."""
-    account = os.getenv("SNOWFLAKE_ACCOUNT")
-    user = os.getenv("SNOWFLAKE_USER")
-    password = os.getenv("SNOWFLAKE_PASSWORD")
-    role = os.getenv("SNOWFLAKE_ROLE")
-    warehouse = os.getenv("SNOWFLAKE_WAREHOUSE")
-    database = os.getenv("SNOWFLAKE_DATABASE")
-    schema = os.getenv("SNOWFLAKE_SCHEMA")
+def compress_schema(
+    prompt: str,
+    table_schemas: Dict[str, List[Dict[str, str]]],
+    relationships_yaml: Optional[Dict[str, Any]] = None
+) -> Dict[str, List[Dict[str, str]]]:
+    """
+    Keep only the columns relevant to a prompt.
+
+    A column is kept when any underscore-separated part of its name appears
+    in the prompt, when it is a primary key, when it is used by a
+    relationship in the YAML, or when it is a NAME column of a table the
+    prompt mentions. If no column matches the prompt by name the
+    full schema is returned unchanged, so the model is never left without
+    the columns it needs.
+    """
+    prompt_tokens = {_normalize_token(t) for t in re.findall(r"[A-Za-z0-9]+", prompt)}
     
-    if not all([account, user, password, role, warehouse, database, schema]):
-        raise ValueError("Missing required Snowflake environment variables")
+    join_columns = set()
+    if relationships_yaml:
+        for rel in relationships_yaml.get('relationships', []):
+            for pair in rel.get('relationshipColumns', []):
+                join_columns.add((rel['leftTable'].upper(), pair['leftColumn'].upper()))
+                join_columns.add((rel['rightTable'].upper(), pair['rightColumn'].upper()))
     
-    return snowflake.connector.connect(
-        account=account,
-        user=user,
-        password=password,
-        role=role,
-        warehouse=warehouse,
-        database=database,
-        schema=schema
-    )
+    compressed = {}
+    matched_any = False
+    for table, columns in table_schemas.items():
+        table_mentioned = _normalize_token(table.split("_")[-1]) in prompt_tokens
+        kept = []
+        for col in columns:
+            name = col['name']
+            parts = [part for part in name.split("_") if part]
+            if any(_normalize_token(part) in prompt_tokens for part in parts):
+                matched_any = True
+                kept.append(col)
+            elif col.get('primary_key') == "Y" or (table.upper(), name.upper()) in join_columns:
+                kept.append(col)
+            elif table_mentioned and "NAME" in (part.upper() for part in parts):
+                kept.append(col)
+        if kept:
+            compressed[table] = kept
+    
+    return compressed if matched_any else table_schemas
 
 
-def load_relationships_yaml(yaml_path: str = "cortex_analyst_relationships.yaml") -> Dict[str, Any]:
-    """Load the relationships YAML file."""
-    if not os.path.exists(yaml_path):
-        raise FileNotFoundError(f"Relationships YAML file not found: {yaml_path}")
-    
-    with open(yaml_path, 'r') as f:
-        return yaml.safe_load(f)
+# Snowflake type code for NUMBER/DECIMAL columns in cursor.description
+_FIXED_TYPE_CODE = 0
 
 
-def get_table_schema(conn: snowflake.connector.SnowflakeConnection, table_name: str) -> List[Dict[str, str]]:
-    """Get column information for a table."""
-    with conn.cursor() as cur:
+def _to_json_value(value: Any) -> Any:
+    """Convert a non-serializable cell (Decimal, dates, ...) for JSON output."""
+    # Convert Decimal to float for JSON serialization
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    # Convert other non-serializable types to string
+    if not isinstance(value, (str, int, float, bool, type(None))):
+        return str(value)
+    return value
+
+
+def _format_rows(rows: List[tuple], description) -> List[Dict[str, Any]]:
+    """
+    Format plain result rows into JSON-friendly row dictionaries.
+
+    The conversion for each column is picked once from the cursor metadata:
+    scaled NUMBER columns are converted straight to float, and only the
+    remaining columns go through the generic per-value check.
+    """
+    columns = [desc[0] for desc in description]
+    converters = []
+    for desc in description:
+        if desc[1] == _FIXED_TYPE_CODE and (desc[5] or 0) > 0:
+            converters.append(lambda v: None if v is None else float(v))
+        else:
+            converters.append(_to_json_value)
+    return [
+        {col: convert(value) for col, convert, value in zip(columns, converters, row)}
+        for row in rows
+    ]
+
+
+def apply_row_limit(sql_query: str, max_rows: int = MAX_RESULT_ROWS) -> str:
+    """
+    Append a LIMIT to a SELECT/WITH query that does not already bound its rows.
+
+    Queries ending in LIMIT/FETCH (ignoring trailing comments) and queries
+    using SELECT TOP are returned unchanged.
+    """
+    if not _QUERY_START_RE.match(sql_query) or _SELECT_TOP_RE.search(sql_query):
+        return sql_query
+    if _TRAILING_LIMIT_RE.search(_TRAILING_COMMENTS_RE.sub("", sql_query)):
+        return sql_query
+    # New line so a trailing "--" comment cannot swallow the LIMIT
+    return f"{sql_query}\nLIMIT {max_rows}"
+
+
+def execute_generated_sql(cur, prompt: str, sql_query: str) -> Dict[str, Any]:
+    """Execute generated SQL and format the rows for JSON output."""
+    try:
+        limited_sql = apply_row_limit(sql_query)
+        cur.execute(limited_sql)
+        columns = [desc[0] for desc in cur.description] if cur.description else []
+        
+        # Prefer the Arrow result path; fall back to plain rows when pandas or
+        # pyarrow are unavailable or the result is not in Arrow format. Both
+        # fetch in batches and stop at MAX_RESULT_ROWS, so memory stays
+        # bounded even when the query carries its own, larger LIMIT
         try:
-            cur.execute(f"DESCRIBE TABLE {table_name}")
-            columns = []
-            for row in cur.fetchall():
-                columns.append({
-                    "name": row[0],
-                    "type": row[1],
-                    "nullable": row[3] if len(row) > 3 else "Y"
-                })
-            return columns
-        except Exception as e:
-            print(f"   ⚠️  Could not get schema for {table_name}: {e}")
-            return []
+            formatted_results, truncated = fetch_frame_records(cur, MAX_RESULT_ROWS)
+        except (ImportError, snowflake.connector.errors.NotSupportedError):
+            formatted_results = []
+            while len(formatted_results) < MAX_RESULT_ROWS:
+                batch = cur.fetchmany(min(FETCH_BATCH_SIZE, MAX_RESULT_ROWS - len(formatted_results)))
+                if not batch:
+                    break
+                formatted_results.extend(_format_rows(batch, cur.description or []))
+            truncated = len(formatted_results) >= MAX_RESULT_ROWS and cur.fetchone() is not None
+        
+        return {
+            "prompt": prompt,
+            "sql_query": limited_sql,
+            "results": formatted_results,
+            "row_count": len(formatted_results),
+            "columns": columns,
+            "truncated": truncated or (limited_sql != sql_query and len(formatted_results) >= MAX_RESULT_ROWS)
+        }
+    except Exception as e:
+        return {
+            "error": f"SQL execution failed: {str(e)}",
+            "sql_query": sql_query
+        }
+
+
+def _sql_cache_key(prompt: str, table_schemas: Dict[str, List[Dict[str, str]]]) -> str:
+    """Fingerprint a prompt together with the schema it was generated against."""
+    payload = prompt + json.dumps(table_schemas, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def get_cached_sql(prompt: str, table_schemas: Dict[str, List[Dict[str, str]]]) -> Optional[str]:
+    """Return previously validated SQL for this prompt and schema, if any."""
+    try:
+        with shelve.open(SQL_CACHE_PATH) as cache:
+            entry = cache.get(_sql_cache_key(prompt, table_schemas))
+    except Exception:
+        return None
+    return entry["sql_query"] if entry else None
+
+
+def store_cached_sql(prompt: str, table_schemas: Dict[str, List[Dict[str, str]]], sql_query: str) -> None:
+    """Remember SQL that executed successfully for this prompt and schema."""
+    try:
+        with shelve.open(SQL_CACHE_PATH) as cache:
+            cache[_sql_cache_key(prompt, table_schemas)] = {"prompt": prompt, "sql_query": sql_query}
+    except Exception as e:
+        print(f"   ⚠️  Could not update SQL cache: {e}")
+
+
+def invalidate_sql_cache(prompt: Optional[str] = None) -> None:
+    """Drop cached SQL for one prompt, or for every prompt when none is given."""
+    with shelve.open(SQL_CACHE_PATH) as cache:
+        if prompt is None:
+            cache.clear()
+            return
+        for key in [k for k, entry in cache.items() if entry.get("prompt") == prompt]:
+            del cache[key]
 
 
 def query_cortex_analyst(
     conn: snowflake.connector.SnowflakeConnection,
     prompt: str,
-    relationships_yaml: Optional[Dict[str, Any]] = None
+    relationships_yaml: Optional[Union[Dict[str, Any], RelationshipContext]] = None
 ) -> Dict[str, Any]:
     """
     Query using Cortex to generate SQL, then execute it.
     """
+    relationships = as_relationship_context(relationships_yaml)
     print(f"\n📝 Processing prompt: {prompt}\n")
     
     # Get table schemas
     print("   Gathering table schemas...")
-    tables = ["ORDERS", "CUSTOMERS", "ORDER_ITEMS", "PRODUCTS", "PAYMENTS"]
-    table_schemas = {}
-    for table in tables:
-        schema = get_table_schema(conn, table)
-        if schema:
-            table_schemas[table] = schema
-            print(f"   ✅ {table}: {len(schema)} columns")
-    
-    # Build enhanced context
-    context = "You are a SQL expert for Snowflake. Generate a valid SQL query.\n\n"
-    context += "Available tables and their columns:\n"
-    for table, columns in table_schemas.items():
-        context += f"\n{table}:\n"
-        for col in columns:
-            context += f"  - {col['name']} ({col['type']})\n"
+    table_schemas = get_table_schemas(conn, ANALYST_TABLES)
+    for table, schema in table_schemas.items():
+        print(f"   ✅ {table}: {len(schema)} columns")
     
-    if relationships_yaml:
-        context += "\nTable relationships:\n"
-        for rel in relationships_yaml.get('relationships', []):
-            left_col = rel['relationshipColumns'][0]['leftColumn']
-            right_col = rel['relationshipColumns'][0]['rightColumn']
-            context += f"- {rel['leftTable']}.{left_col} -> {rel['rightTable']}.{right_col} ({rel['relationshipType']})\n"
+    cached_sql = get_cached_sql(prompt, table_schemas)
+    if cached_sql:
+        print(f"\n   ✅ Using cached SQL:\n   {cached_sql}\n")
+        with conn.cursor() as cur:
+            return execute_generated_sql(cur, prompt, cached_sql)
     
-    context += f"\nQuestion: {prompt}\n"
-    context += "Generate ONLY the SQL SELECT query. No explanations, no markdown, just SQL."
+    context = build_sql_context(
+        prompt,
+        compress_schema(prompt, table_schemas, relationships.yaml if relationships else None),
+        relationships
+    )
     
     # Generate SQL using Cortex
     print("\n   Generating SQL using Cortex...")
+    generated, model = race_cortex_complete(conn, context)
+    if not generated:
+        return {"error": "Could not generate SQL query using Cortex"}
+    
+    sql_query = clean_generated_sql(generated)
+    print(f"   ✅ Generated SQL using {model}")
+    print(f"\n   Generated SQL:\n   {sql_query}\n")
+    
+    # Execute the SQL
+    print("   Executing SQL query...")
     with conn.cursor() as cur:
-        models = ['llama3-8b', 'mistral-7b', 'snowflake-arctic']
-        sql_query = None
-        
-        for model in models:
-            try:
-                cur.execute(
-                    f"SELECT SNOWFLAKE.CORTEX.COMPLETE('{model}', %s)",
-                    (context,)
-                )
-                result = cur.fetchone()
-                if result and result[0]:
-                    sql_query = result[0].strip()
-                    # Clean up
-                    for prefix in ["```sql", "```", "SQL:", "Query:"]:
-                        if sql_query.startswith(prefix):
-                            sql_query = sql_query[len(prefix):].strip()
-                    if sql_query.endswith("```"):
-                        sql_query = sql_query[:-3].strip()
-                    sql_query = sql_query.strip().rstrip(';')
-                    print(f"   ✅ Generated SQL using {model}")
-                    break
-            except Exception as e:
-                continue
-        
-        if not sql_query:
-            return {"error": "Could not generate SQL query using Cortex"}
-        
-        print(f"\n   Generated SQL:\n   {sql_query}\n")
-        
-        # Execute the SQL
-        print("   Executing SQL query...")
+        result = execute_generated_sql(cur, prompt, sql_query)
+    if "error" not in result:
+        store_cached_sql(prompt, table_schemas, sql_query)
+    return result
+
+
+def query_cortex_analyst_batch(
+    conn: snowflake.connector.SnowflakeConnection,
+    prompts: List[str],
+    relationships_yaml: Optional[Union[Dict[str, Any], RelationshipContext]] = None
+) -> List[Dict[str, Any]]:
+    """
+    Generate and execute SQL for several prompts.
+
+    All prompts are sent to Cortex in one statement that evaluates COMPLETE
+    over a VALUES list, so N prompts cost one round-trip per model instead
+    of N. Results are returned in the same order as ``prompts``.
+    """
+    if not prompts:
+        return []
+    
+    relationships = as_relationship_context(relationships_yaml)
+    relationships_dict = relationships.yaml if relationships else None
+    table_schemas = get_table_schemas(conn, ANALYST_TABLES)
+    cached = [get_cached_sql(prompt, table_schemas) for prompt in prompts]
+    contexts = [
+        build_sql_context(prompt, compress_schema(prompt, table_schemas, relationships_dict), relationships)
+        for prompt in prompts
+    ]
+    sql_queries: List[Optional[str]] = list(cached)
+    
+    pending = [i for i, sql_query in enumerate(sql_queries) if not sql_query]
+    if pending:
         try:
-            cur.execute(sql_query)
-            results = cur.fetchall()
-            columns = [desc[0] for desc in cur.description] if cur.description else []
-            
-            # Format results (handle Decimal and other non-serializable types)
-            import decimal
-            formatted_results = []
-            for row in results:
-                row_dict = {}
-                for i, col in enumerate(columns):
-                    value = row[i]
-                    # Convert Decimal to float for JSON serialization
-                    if isinstance(value, decimal.Decimal):
-                        value = float(value)
-                    # Convert other non-serializable types to string
-                    elif not isinstance(value, (str, int, float, bool, type(None))):
-                        value = str(value)
-                    row_dict[col] = value
-                formatted_results.append(row_dict)
-            
-            return {
-                "prompt": prompt,
-                "sql_query": sql_query,
-                "results": formatted_results,
-                "row_count": len(formatted_results),
-                "columns": columns
-            }
-        except Exception as e:
-            return {
-                "error": f"SQL execution failed: {str(e)}",
-                "sql_query": sql_query
-            }
+            answers, _model = complete_batch(conn, [contexts[i] for i in pending], SQL_MODELS)
+        except Exception:
+            answers = []
+        for i, text in zip(pending, answers):
+            if text:
+                sql_queries[i] = clean_generated_sql(text)
+    
+    with conn.cursor() as cur:
+        results = []
+        for prompt, sql_query, cached_sql in zip(prompts, sql_queries, cached):
+            if not sql_query:
+                results.append({"prompt": prompt, "error": "Could not generate SQL query using Cortex"})
+                continue
+            result = execute_generated_sql(cur, prompt, sql_query)
+            if "error" not in result and not cached_sql:
+                store_cached_sql(prompt, table_schemas, sql_query)
+            results.append(result)
+        return results
 
 
 def main():
@@ -188,31 +340,30 @@ def main():
     try:
         # Load relationships
         print("\n1. Loading relationships configuration...")
-        relationships = load_relationships_yaml()
-        print(f"   ✅ Loaded {len(relationships.get('relationships', []))} relationships")
+        relationships = load_relationship_context()
+        print(f"   ✅ Loaded {len(relationships.yaml.get('relationships', []))} relationships")
         
         # Connect
         print("\n2. Connecting to Snowflake...")
-        conn = get_snowflake_connection()
-        print("   ✅ Connected successfully")
-        
-        # Run query
-        print("\n3. Running Cortex Analyst query...")
-        sample_prompt = "What are the top 5 customers by total order value?"
-        
-        result = query_cortex_analyst(
-            conn=conn,
-            prompt=sample_prompt,
-            relationships_yaml=relationships
-        )
+        with snowflake_session() as conn:
+            print("   ✅ Connected successfully")
+            
+            # Run query
+            print("\n3. Running Cortex Analyst query...")
+            sample_prompt = "What are the top 5 customers by total order value?"
+            
+            result = query_cortex_analyst(
+                conn=conn,
+                prompt=sample_prompt,
+                relationships_yaml=relationships
+            )
         
         print("\n" + "=" * 70)
         print("CORTEX ANALYST RESPONSE:")
         print("=" * 70)
-        print(json.dumps(result, indent=2, default=str))
+        print(dumps_json(result))
         print("=" * 70)
         
-        conn.close()
         print("\n✅ Query completed!")
         
     except Exception as e:
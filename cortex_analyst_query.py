@@ -5,11 +5,9 @@ This script demonstrates how to use Snowflake Cortex Analyst to query
 structured tables using natural language prompts.
 """
 
-import os
 import sys
 from typing import Dict, Any, Optional
 import json
-import yaml
 
 # Fix Windows console encoding for emoji support
 if sys.platform == 'win32':
@@ -21,43 +19,12 @@ if sys.platform == 'win32':
 import snowflake.connector
 from dotenv import load_dotenv
 
+from cortex_common import dumps_json, get_snowflake_connection, load_relationships_yaml
+
 # Load environment variables
 load_dotenv()
 
 
-def get_snowflake_connection() -> snowflake.connector.SnowflakeConnection:
-    """Create and return a Snowflake connection."""
-    account = os.getenv("SNOWFLAKE_ACCOUNT")
-    user = os.getenv("SNOWFLAKE_USER")
-    password = os.getenv("SNOWFLAKE_PASSWORD")
-    role = os.getenv("SNOWFLAKE_ROLE")
-    warehouse = os.getenv("SNOWFLAKE_WAREHOUSE")
-    database = os.getenv("SNOWFLAKE_DATABASE")
-    schema = os.getenv("SNOWFLAKE_SCHEMA")
-    
-    if not all([account, user, password, role, warehouse, database, schema]):
-        raise ValueError("Missing required Snowflake environment variables")
-    
-    return snowflake.connector.connect(
-        account=account,
-        user=user,
-        password=password,
-        role=role,
-        warehouse=warehouse,
-        database=database,
-        schema=schema
-    )
-
-
-def load_relationships_yaml(yaml_path: str = "cortex_analyst_relationships.yaml") -> Dict[str, Any]:
-    """Load the relationships YAML file."""
-    if not os.path.exists(yaml_path):
-        raise FileNotFoundError(f"Relationships YAML file not found: {yaml_path}")
-    
-    with open(yaml_path, 'r') as f:
-        return yaml.safe_load(f)
-
-
 def create_cortex_analyst_session(
     conn: snowflake.connector.SnowflakeConnection,
     relationships_yaml: Dict[str, Any],
@@ -78,15 +45,15 @@ def create_cortex_analyst_session(
         # Create the Cortex Analyst session
         # Note: The exact SQL syntax may vary based on Snowflake version
         # This uses the CORTEX.ANALYST_CREATE_SESSION function
-        create_session_sql = f"""
+        create_session_sql = """
         SELECT SNOWFLAKE.CORTEX.ANALYST_CREATE_SESSION(
-            '{session_name}',
-            PARSE_JSON('{relationships_json}')
+            %s,
+            PARSE_JSON(%s)
         ) AS SESSION_ID
         """
         
         try:
-            cur.execute(create_session_sql)
+            cur.execute(create_session_sql, (session_name, relationships_json))
             result = cur.fetchone()
             session_id = result[0] if result else None
             
@@ -130,21 +97,23 @@ def query_cortex_analyst(
             # This is the most common approach
             if relationships_yaml:
                 relationships_json = json.dumps(relationships_yaml)
-                sql = f"""
+                sql = """
                 SELECT SNOWFLAKE.CORTEX.ANALYST(
-                    '{prompt}',
-                    PARSE_JSON('{relationships_json}')
+                    %s,
+                    PARSE_JSON(%s)
                 ) AS RESULT
                 """
+                params = (prompt, relationships_json)
             else:
-                sql = f"""
-                SELECT SNOWFLAKE.CORTEX.ANALYST('{prompt}') AS RESULT
+                sql = """
+                SELECT SNOWFLAKE.CORTEX.ANALYST(%s) AS RESULT
                 """
+                params = (prompt,)
             
             print(f"\n📝 Executing Cortex Analyst query...")
             print(f"   Prompt: {prompt}\n")
             
-            cur.execute(sql)
+            cur.execute(sql, params)
             result = cur.fetchone()
             
             if result and result[0]:
@@ -171,18 +140,20 @@ def query_cortex_analyst(
                 try:
                     if relationships_yaml:
                         relationships_json = json.dumps(relationships_yaml)
-                        alt_sql = f"""
+                        alt_sql = """
                         SELECT SNOWFLAKE.CORTEX.ANALYST_QUERY(
-                            '{prompt}',
-                            PARSE_JSON('{relationships_json}')
+                            %s,
+                            PARSE_JSON(%s)
                         ) AS RESULT
                         """
+                        alt_params = (prompt, relationships_json)
                     else:
-                        alt_sql = f"""
-                        SELECT SNOWFLAKE.CORTEX.ANALYST_QUERY('{prompt}') AS RESULT
+                        alt_sql = """
+                        SELECT SNOWFLAKE.CORTEX.ANALYST_QUERY(%s) AS RESULT
                         """
+                        alt_params = (prompt,)
                     
-                    cur.execute(alt_sql)
+                    cur.execute(alt_sql, alt_params)
                     result = cur.fetchone()
                     
                     if result and result[0]:
@@ -231,7 +202,7 @@ def main():
         print("=" * 70)
         
         if isinstance(result, dict):
-            print(json.dumps(result, indent=2))
+            print(dumps_json(result))
         else:
             print(result)
         
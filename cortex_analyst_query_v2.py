@@ -3,11 +3,11 @@ Snowflake Cortex Analyst Integration Script (Version 2)
 Uses REST API approach if SQL functions are not available
 """
 
-import os
 import sys
-from typing import Dict, Any, Optional
+import time
+from pathlib import Path
+from typing import Dict, Any, Optional, Tuple, Set
 import json
-import yaml
 import requests
 from base64 import b64encode
 
@@ -21,53 +21,142 @@ if sys.platform == 'win32':
 import snowflake.connector
 from dotenv import load_dotenv
 
-# Load environment variables
+from cortex_common import (
+    clean_generated_sql,
+    dumps_json,
+    get_snowflake_connection,
+    load_relationships_yaml,
+    race_cortex_complete,
+)
+
 load_dotenv()
 
 
-def get_snowflake_connection() -> snowflake.connector.SnowflakeConnection:
-    """Create and return a Snowflake connection."""
-    account = os.getenv("SNOWFLAKE_ACCOUNT")
-    user = os.getenv("SNOWFLAKE_USER")
-    password = os.getenv("SNOWFLAKE_PASSWORD")
-    role = os.getenv("SNOWFLAKE_ROLE")
-    warehouse = os.getenv("SNOWFLAKE_WAREHOUSE")
-    database = os.getenv("SNOWFLAKE_DATABASE")
-    schema = os.getenv("SNOWFLAKE_SCHEMA")
-    
-    if not all([account, user, password, role, warehouse, database, schema]):
-        raise ValueError("Missing required Snowflake environment variables")
-    
-    return snowflake.connector.connect(
-        account=account,
-        user=user,
-        password=password,
-        role=role,
-        warehouse=warehouse,
-        database=database,
-        schema=schema
-    )
-
-
-def load_relationships_yaml(yaml_path: str = "cortex_analyst_relationships.yaml") -> Dict[str, Any]:
-    """Load the relationships YAML file."""
-    if not os.path.exists(yaml_path):
-        raise FileNotFoundError(f"Relationships YAML file not found: {yaml_path}")
-    
-    with open(yaml_path, 'r') as f:
-        return yaml.safe_load(f)
+# Try the correct function name based on Snowflake documentation
+# Cortex Analyst might use ANALYZE_DATA or similar
+ANALYST_FUNCTION_CANDIDATES = (
+    ("SNOWFLAKE.CORTEX.ANALYZE_DATA", True),
+    ("SNOWFLAKE.CORTEX.ANALYST", True),
+    ("CORTEX.ANALYZE_DATA", True),
+    ("CORTEX.ANALYST", True),
+)
+ANALYST_FUNCTION_NAMES = frozenset(name for name, _ in ANALYST_FUNCTION_CANDIDATES)
+
+
+# Probe results (version, Cortex functions) per account/database, so repeated
+# runs skip the SHOW/INFORMATION_SCHEMA round-trips for a day.
+CAPABILITY_CACHE_PATH = Path.home() / ".cortex_caps.json"
+CAPABILITY_CACHE_TTL_SECONDS = 24 * 60 * 60
+
+# Analyst function that last worked, per account/database (see _capability_key)
+_WORKING_ANALYST_FUNCTION: Dict[str, str] = {}
+
+
+def _capability_key(conn: snowflake.connector.SnowflakeConnection) -> str:
+    """Cache key identifying the account and database of a connection."""
+    return f"{conn.account}|{conn.database}"
+
+
+def _load_capability_cache() -> Dict[str, Any]:
+    """Read the capability cache file, returning an empty dict if unusable."""
+    try:
+        with open(CAPABILITY_CACHE_PATH, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _get_cached_capabilities(conn: snowflake.connector.SnowflakeConnection) -> Dict[str, Any]:
+    """Return the cached capabilities for this connection if still fresh."""
+    entry = _load_capability_cache().get(_capability_key(conn))
+    if entry and time.time() - entry.get("timestamp", 0) < CAPABILITY_CACHE_TTL_SECONDS:
+        return entry
+    return {}
+
+
+def _update_cached_capabilities(conn: snowflake.connector.SnowflakeConnection, **values: Any) -> None:
+    """Merge probe results into the cache entry for this connection."""
+    cache = _load_capability_cache()
+    key = _capability_key(conn)
+    entry = cache.get(key, {})
+    if time.time() - entry.get("timestamp", 0) >= CAPABILITY_CACHE_TTL_SECONDS:
+        entry = {}
+    entry.update(values)
+    entry.setdefault("timestamp", time.time())
+    cache[key] = entry
+    try:
+        with open(CAPABILITY_CACHE_PATH, 'w') as f:
+            json.dump(cache, f, indent=2)
+    except OSError as e:
+        print(f"   ⚠️  Could not write capability cache: {e}")
+
+
+def invalidate_capability_cache(conn: snowflake.connector.SnowflakeConnection) -> None:
+    """Forget cached probe results for this connection's account and database."""
+    cache = _load_capability_cache()
+    if cache.pop(_capability_key(conn), None) is not None:
+        try:
+            with open(CAPABILITY_CACHE_PATH, 'w') as f:
+                json.dump(cache, f, indent=2)
+        except OSError:
+            pass
 
 
 def check_snowflake_version(conn: snowflake.connector.SnowflakeConnection) -> str:
     """Check Snowflake version."""
+    cached = _get_cached_capabilities(conn)
+    if "version" in cached:
+        return cached["version"]
+    
     with conn.cursor() as cur:
         cur.execute("SELECT CURRENT_VERSION()")
         result = cur.fetchone()
-        return result[0] if result else "Unknown"
+        version = result[0] if result else "Unknown"
+    if result:
+        _update_cached_capabilities(conn, version=version)
+    return version
+
+
+def _probe_analyst_functions(cur) -> Optional[Set[str]]:
+    """
+    Return which Cortex Analyst candidate functions exist, or None if unknown.
+
+    Only SNOWFLAKE.CORTEX is listed, so only the fully qualified candidates
+    can be confirmed; the unqualified CORTEX.* names resolve in the current
+    database and are never reported as present.
+    """
+    prefix = "SNOWFLAKE.CORTEX."
+    try:
+        cur.execute("SHOW FUNCTIONS IN SCHEMA SNOWFLAKE.CORTEX")
+        names = {row[1].upper() for row in cur.fetchall()}
+    except Exception:
+        return None
+    return {
+        func_name for func_name in ANALYST_FUNCTION_NAMES
+        if func_name.startswith(prefix) and func_name[len(prefix):] in names
+    }
 
 
-def check_cortex_availability(conn: snowflake.connector.SnowflakeConnection):
-    """Check if Cortex functions are available."""
+def check_cortex_availability(
+    conn: snowflake.connector.SnowflakeConnection
+) -> Tuple[bool, Optional[Set[str]]]:
+    """
+    Check if Cortex functions are available.
+
+    Returns:
+        Tuple of (Cortex available, Analyst function names that exist).
+        The function set is None when it could not be determined.
+    """
+    cached = _get_cached_capabilities(conn)
+    if "cortex_available" in cached:
+        print(f"   ✅ Using cached Cortex availability ({len(cached.get('functions', []))} functions)")
+        analyst_functions = cached.get("analyst_functions")
+        # The cache file is outside our control; keep only known function names
+        return (
+            cached["cortex_available"],
+            set(analyst_functions) & ANALYST_FUNCTION_NAMES if analyst_functions is not None else None
+        )
+    
     with conn.cursor() as cur:
         try:
             # Check for CORTEX schema
@@ -85,59 +174,72 @@ def check_cortex_availability(conn: snowflake.connector.SnowflakeConnection):
                 LIMIT 10
             """)
             functions = cur.fetchall()
+            function_names = [func[0] for func in functions]
+            analyst_functions = _probe_analyst_functions(cur)
+            _update_cached_capabilities(
+                conn,
+                cortex_available=bool(functions),
+                functions=function_names,
+                analyst_functions=sorted(analyst_functions) if analyst_functions is not None else None
+            )
             if functions:
                 print(f"   ✅ Found {len(functions)} Cortex functions:")
                 for func in functions[:5]:
                     print(f"      - {func[0]}")
-                return True
+                return True, analyst_functions
             else:
                 print("   ⚠️  No Cortex functions found")
-                return False
+                return False, analyst_functions
         except Exception as e:
             print(f"   ⚠️  Could not check Cortex availability: {e}")
-            return False
+            return False, None
 
 
 def query_cortex_analyst_sql(
     conn: snowflake.connector.SnowflakeConnection,
     prompt: str,
-    relationships_yaml: Optional[Dict[str, Any]] = None
+    relationships_yaml: Optional[Dict[str, Any]] = None,
+    available_functions: Optional[Set[str]] = None
 ) -> Dict[str, Any]:
     """
     Try to query Cortex Analyst using SQL functions.
+
+    Only functions known to exist (``available_functions``, as returned by
+    check_cortex_availability) are tried. The first function that works is
+    remembered for the connection's account and database and used directly
+    on later calls.
     """
+    candidates = ANALYST_FUNCTION_CANDIDATES
+    chosen = _WORKING_ANALYST_FUNCTION.get(_capability_key(conn))
+    if chosen:
+        candidates = tuple(c for c in candidates if c[0] == chosen)
+    elif available_functions is not None:
+        candidates = tuple(c for c in candidates if c[0] in available_functions)
+    
     with conn.cursor() as cur:
-        escaped_prompt = prompt.replace("'", "''")
-        
-        # Try the correct function name based on Snowflake documentation
-        # Cortex Analyst might use ANALYZE_DATA or similar
-        function_candidates = [
-            ("SNOWFLAKE.CORTEX.ANALYZE_DATA", True),
-            ("SNOWFLAKE.CORTEX.ANALYST", True),
-            ("CORTEX.ANALYZE_DATA", True),
-            ("CORTEX.ANALYST", True),
-        ]
-        
         if relationships_yaml:
             relationships_json = json.dumps(relationships_yaml)
-            escaped_json = relationships_json.replace("'", "''")
         
-        for func_name, use_relationships in function_candidates:
+        # Candidates always come from ANALYST_FUNCTION_CANDIDATES, so only those
+        # names are ever interpolated; user input is bound
+        for func_name, use_relationships in candidates:
             try:
                 if relationships_yaml and use_relationships:
                     sql = f"""
                     SELECT {func_name}(
-                        '{escaped_prompt}',
-                        PARSE_JSON('{escaped_json}')
+                        %s,
+                        PARSE_JSON(%s)
                     ) AS RESULT
                     """
+                    params = (prompt, relationships_json)
                 else:
                     sql = f"""
-                    SELECT {func_name}('{escaped_prompt}') AS RESULT
+                    SELECT {func_name}(%s) AS RESULT
                     """
+                    params = (prompt,)
                 
                 print(f"   Trying: {func_name}...")
-                cur.execute(sql)
+                cur.execute(sql, params)
                 result = cur.fetchone()
                 
                 if result and result[0]:
@@ -148,6 +250,7 @@ def query_cortex_analyst_sql(
                         except json.JSONDecodeError:
                             pass
                     print(f"   ✅ Success with {func_name}!")
+                    _WORKING_ANALYST_FUNCTION[_capability_key(conn)] = func_name
                     return response
             except Exception as e:
                 error_msg = str(e)
@@ -171,43 +274,29 @@ def query_using_sql_generation(
     print("\n   Trying SQL generation approach...")
     
     # Build context about the tables and relationships
-    context = "You are a SQL expert. Generate a SQL query for the following question.\n"
-    context += "Available tables: ORDERS, CUSTOMERS, ORDER_ITEMS, PRODUCTS, PAYMENTS\n"
+    parts = [
+        "You are a SQL expert. Generate a SQL query for the following question.\n",
+        "Available tables: ORDERS, CUSTOMERS, ORDER_ITEMS, PRODUCTS, PAYMENTS\n",
+    ]
     
     if relationships_yaml:
-        context += "\nTable relationships:\n"
+        parts.append("\nTable relationships:\n")
         for rel in relationships_yaml.get('relationships', []):
-            context += f"- {rel['leftTable']}.{rel['relationshipColumns'][0]['leftColumn']} -> {rel['rightTable']}.{rel['relationshipColumns'][0]['rightColumn']} ({rel['relationshipType']})\n"
+            parts.append(f"- {rel['leftTable']}.{rel['relationshipColumns'][0]['leftColumn']} -> {rel['rightTable']}.{rel['relationshipColumns'][0]['rightColumn']} ({rel['relationshipType']})\n")
     
-    context += f"\nQuestion: {prompt}\n"
-    context += "Generate only the SQL query, no explanations."
+    parts.append(f"\nQuestion: {prompt}\n")
+    parts.append("Generate only the SQL query, no explanations.")
+    context = "".join(parts)
     
     with conn.cursor() as cur:
         try:
-            # Use CORTEX.COMPLETE to generate SQL
+            # Use CORTEX.COMPLETE to generate SQL, racing all models
             models = ['llama3-8b', 'mistral-7b', 'snowflake-arctic']
-            sql_query = None
+            sql_query, _model = race_cortex_complete(conn, context, models)
             
-            for model in models:
-                try:
-                    cur.execute(
-                        f"SELECT SNOWFLAKE.CORTEX.COMPLETE('{model}', %s)",
-                        (context,)
-                    )
-                    result = cur.fetchone()
-                    if result and result[0]:
-                        sql_query = result[0].strip()
-                        # Clean up the SQL (remove markdown code blocks if present)
-                        if sql_query.startswith("```sql"):
-                            sql_query = sql_query[6:]
-                        if sql_query.startswith("```"):
-                            sql_query = sql_query[3:]
-                        if sql_query.endswith("```"):
-                            sql_query = sql_query[:-3]
-                        sql_query = sql_query.strip()
-                        break
-                except:
-                    continue
+            if sql_query:
+                # Clean up the SQL (remove markdown code blocks if present)
+                sql_query = clean_generated_sql(sql_query)
             
             if not sql_query:
                 return {"error": "Could not generate SQL query"}
@@ -220,9 +309,8 @@ def query_using_sql_generation(
             columns = [desc[0] for desc in cur.description] if cur.description else []
             
             # Format results
-            formatted_results = []
-            for row in results:
-                formatted_results.append(dict(zip(columns, row)))
+            cols = tuple(columns)
+            formatted_results = [dict(zip(cols, row)) for row in results]
             
             return {
                 "sql_query": sql_query,
@@ -255,7 +343,7 @@ def main():
         print("\n3. Checking Snowflake version and Cortex availability...")
         version = check_snowflake_version(conn)
         print(f"   Snowflake version: {version}")
-        cortex_available = check_cortex_availability(conn)
+        cortex_available, analyst_functions = check_cortex_availability(conn)
         
         # Test query
         print("\n4. Running sample Cortex Analyst query...")
@@ -266,11 +354,17 @@ def main():
         result = query_cortex_analyst_sql(
             conn=conn,
             prompt=sample_prompt,
-            relationships_yaml=relationships
+            relationships_yaml=relationships,
+            available_functions=analyst_functions
         )
         
         # If SQL approach failed, try SQL generation approach
         if not result or "error" in result:
+            # A function the probe listed as available was called and failed,
+            # so the cached probe results may be stale; re-check on the next run.
+            # When none were listed nothing was tried and the cache stays valid
+            if analyst_functions:
+                invalidate_capability_cache(conn)
             print("\n   SQL function approach not available, trying SQL generation...")
             result = query_using_sql_generation(
                 conn=conn,
@@ -283,7 +377,7 @@ def main():
         print("=" * 70)
         
         if isinstance(result, dict):
-            print(json.dumps(result, indent=2, default=str))
+            print(dumps_json(result))
         else:
             print(result)
         
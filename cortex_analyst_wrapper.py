@@ -2,37 +2,23 @@
 Wrapper module for Cortex Analyst queries
 """
 
-import os
-from typing import Dict, Any, Optional, List
-import json
-import yaml
-from snowflake_connect import connect_snowflake
+from typing import Dict, Any, Optional
+from snowflake.connector.errors import NotSupportedError
+from snowflake_connect import pooled_conn
+from cortex_batching import COMPLETE_TIMEOUT_SECONDS, BatchingCompleter
+from cortex_common import (
+    ANALYST_TABLES,
+    SQL_MODELS,
+    as_relationship_context,
+    build_sql_context,
+    clean_generated_sql,
+    fetch_frame_records,
+    get_table_schemas,
+    load_relationships_yaml,
+)
 
-
-def load_relationships_yaml(yaml_path: str = "cortex_analyst_relationships.yaml") -> Dict[str, Any]:
-    """Load the relationships YAML file."""
-    if not os.path.exists(yaml_path):
-        raise FileNotFoundError(f"Relationships YAML file not found: {yaml_path}")
-    
-    with open(yaml_path, 'r') as f:
-        return yaml.safe_load(f)
-
-
-def get_table_schema(conn, table_name: str) -> List[Dict[str, str]]:
-    """Get column information for a table."""
-    with conn.cursor() as cur:
-        try:
-            cur.execute(f"DESCRIBE TABLE {table_name}")
-            columns = []
-            for row in cur.fetchall():
-                columns.append({
-                    "name": row[0],
-                    "type": row[1],
-                    "nullable": row[3] if len(row) > 3 else "Y"
-                })
-            return columns
-        except Exception as e:
-            return []
+# SQL generation requests from concurrent callers share COMPLETE statements
+_COMPLETER = BatchingCompleter(models=SQL_MODELS)
 
 
 def query_cortex_analyst_wrapper(
@@ -49,8 +35,6 @@ def query_cortex_analyst_wrapper(
     Returns:
         Dictionary with results
     """
-    import os
-    
     # Load relationships if not provided
     if relationships_yaml is None:
         try:
@@ -58,79 +42,41 @@ def query_cortex_analyst_wrapper(
         except:
             relationships_yaml = None
     
-    conn = connect_snowflake()
+    # Get table schemas. The connection is only held for schema lookup and for
+    # running the generated SQL: the batcher borrows its own pooled connection,
+    # so holding one while waiting on it could exhaust the pool and deadlock
+    with pooled_conn() as conn:
+        table_schemas = get_table_schemas(conn, ANALYST_TABLES)
+    
+    # Build enhanced context
+    context = build_sql_context(prompt, table_schemas, as_relationship_context(relationships_yaml))
     
+    # Generate SQL using Cortex (batched with any concurrent prompts)
     try:
-        # Get table schemas
-        tables = ["ORDERS", "CUSTOMERS", "ORDER_ITEMS", "PRODUCTS", "PAYMENTS"]
-        table_schemas = {}
-        for table in tables:
-            schema = get_table_schema(conn, table)
-            if schema:
-                table_schemas[table] = schema
-        
-        # Build enhanced context
-        context = "You are a SQL expert for Snowflake. Generate a valid SQL query.\n\n"
-        context += "Available tables and their columns:\n"
-        for table, columns in table_schemas.items():
-            context += f"\n{table}:\n"
-            for col in columns:
-                context += f"  - {col['name']} ({col['type']})\n"
-        
-        if relationships_yaml:
-            context += "\nTable relationships:\n"
-            for rel in relationships_yaml.get('relationships', []):
-                left_col = rel['relationshipColumns'][0]['leftColumn']
-                right_col = rel['relationshipColumns'][0]['rightColumn']
-                context += f"- {rel['leftTable']}.{left_col} -> {rel['rightTable']}.{right_col} ({rel['relationshipType']})\n"
-        
-        context += f"\nQuestion: {prompt}\n"
-        context += "Generate ONLY the SQL SELECT query. No explanations, no markdown, just SQL."
-        
-        # Generate SQL using Cortex
+        generated = _COMPLETER.complete(context).result(timeout=COMPLETE_TIMEOUT_SECONDS)
+    except Exception:
+        generated = None
+    sql_query = clean_generated_sql(generated) if generated else None
+    
+    if not sql_query:
+        return {
+            "error": "Could not generate SQL query using Cortex",
+            "system": "CORTEX_ANALYST"
+        }
+    
+    with pooled_conn() as conn:
         with conn.cursor() as cur:
-            models = ['llama3-8b', 'mistral-7b', 'snowflake-arctic']
-            sql_query = None
-            
-            for model in models:
-                try:
-                    cur.execute(
-                        f"SELECT SNOWFLAKE.CORTEX.COMPLETE('{model}', %s)",
-                        (context,)
-                    )
-                    result = cur.fetchone()
-                    if result and result[0]:
-                        sql_query = result[0].strip()
-                        # Clean up
-                        for prefix in ["```sql", "```", "SQL:", "Query:"]:
-                            if sql_query.startswith(prefix):
-                                sql_query = sql_query[len(prefix):].strip()
-                        if sql_query.endswith("```"):
-                            sql_query = sql_query[:-3].strip()
-                        sql_query = sql_query.strip().rstrip(';')
-                        break
-                except Exception:
-                    continue
-            
-            if not sql_query:
-                return {
-                    "error": "Could not generate SQL query using Cortex",
-                    "system": "CORTEX_ANALYST"
-                }
-            
             # Execute the SQL
             try:
                 cur.execute(sql_query)
-                results = cur.fetchall()
                 columns = [desc[0] for desc in cur.description] if cur.description else []
                 
-                # Format results
-                formatted_results = []
-                for row in results:
-                    row_dict = {}
-                    for i, col in enumerate(columns):
-                        row_dict[col] = row[i]
-                    formatted_results.append(row_dict)
+                # Format results from the Arrow fetch path, which converts whole
+                # columns natively instead of building each row dict in Python
+                try:
+                    formatted_results, _ = fetch_frame_records(cur)
+                except (ImportError, NotSupportedError):
+                    formatted_results = [dict(zip(columns, row)) for row in cur.fetchall()]
                 
                 return {
                     "system": "CORTEX_ANALYST",
@@ -148,5 +94,3 @@ def query_cortex_analyst_wrapper(
                     "system": "CORTEX_ANALYST",
                     "success": False
                 }
-    finally:
-        conn.close()
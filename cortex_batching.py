@@ -0,0 +1,129 @@
+"""
+Micro-batching for SNOWFLAKE.CORTEX.COMPLETE calls.
+
+Concurrent callers (e.g. several Streamlit sessions) submit prompts to a
+shared BatchingCompleter; a background thread collects them for a few
+milliseconds and sends each batch to Snowflake as a single statement.
+"""
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, ContextManager, List, Optional, Sequence, Tuple
+
+from snowflake_connect import pooled_conn
+from cortex_common import complete_batch, models_in_order
+
+# How long callers wait on a completion future before giving up
+COMPLETE_TIMEOUT_SECONDS = 300
+
+
+class BatchingCompleter:
+    """
+    Send concurrent COMPLETE prompts to Snowflake in batches.
+
+    Up to ``batch_size`` prompts submitted within ``batch_timeout_ms`` of the
+    first one are completed by one ``SELECT ... FROM VALUES`` statement (see
+    cortex_common.complete_batch), so the per-query overhead is paid once per
+    batch instead of once per prompt. The first ``speculate`` models run the
+    batch concurrently and the first to succeed wins; prompts still without
+    an answer then go to the remaining models in order. The model that
+    answered last is tried first next time, so an unavailable preferred
+    model is not retried for every batch.
+    """
+
+    def __init__(
+        self,
+        models: Sequence[str],
+        batch_size: int = 8,
+        batch_timeout_ms: int = 50,
+        speculate: int = 2,
+        connection: Callable[[], ContextManager] = pooled_conn
+    ):
+        """
+        Args:
+            models: Cortex model names in order of preference
+            batch_size: Maximum number of prompts per statement
+            batch_timeout_ms: How long to wait for more prompts after the first
+            speculate: Number of preferred models raced against each other
+            connection: Context manager factory lending a Snowflake connection per batch
+        """
+        self.models = list(models)
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout_ms / 1000.0
+        self.speculate = speculate
+        self._connection = connection
+        self._queue: "queue.Queue[Tuple[str, Future]]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._working_model: Optional[str] = None
+
+    def complete(self, prompt: str) -> Future:
+        """
+        Queue a prompt for completion.
+
+        Args:
+            prompt: Prompt text
+
+        Returns:
+            Future resolving to the model's answer (or raising if every model failed)
+        """
+        future: Future = Future()
+        self._ensure_worker()
+        self._queue.put((prompt, future))
+        return future
+
+    def _ensure_worker(self) -> None:
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="cortex-batcher", daemon=True)
+                self._thread.start()
+
+    def _next_batch(self) -> List[Tuple[str, Future]]:
+        """Block for one prompt, then gather more until the batch is full or times out."""
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.batch_timeout
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = [(prompt, future) for prompt, future in self._next_batch()
+                     if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                answers = self._complete_batch([prompt for prompt, _ in batch])
+            except Exception as e:
+                if len(batch) == 1:
+                    batch[0][1].set_exception(e)
+                    continue
+                # One bad or over-long prompt fails the whole statement; retry
+                # the prompts one at a time so only the offending one fails
+                for prompt, future in batch:
+                    try:
+                        (answer,) = self._complete_batch([prompt])
+                    except Exception as single_error:
+                        future.set_exception(single_error)
+                    else:
+                        future.set_result(answer)
+            else:
+                for (_, future), answer in zip(batch, answers):
+                    future.set_result(answer)
+
+    def _complete_batch(self, prompts: List[str]) -> List[Optional[str]]:
+        """Complete a batch of prompts in one statement, returning answers in input order."""
+        with self._connection() as conn:
+            answers, model = complete_batch(
+                conn, prompts, models_in_order(self.models, self._working_model), self.speculate
+            )
+        self._working_model = model
+        return answers
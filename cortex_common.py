@@ -0,0 +1,700 @@
+"""
+Shared helpers for the Cortex Analyst scripts.
+
+Connection handling, relationships loading, table schema discovery, SQL
+cleanup, model racing, result formatting and JSON output live here so the
+analyst entrypoints (cortex_analyst_final.py, cortex_analyst_query.py,
+cortex_analyst_query_v2.py) only contain their own query logic. The RAG
+modules and wrappers reuse the async query racing and schema lookup.
+"""
+
+import os
+import re
+import atexit
+import decimal
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, Any, Optional, List, Tuple, Iterator, Callable, Sequence
+import json
+import yaml
+
+import snowflake.connector
+
+# libyaml's C loader is much faster than the pure-Python SafeLoader
+try:
+    from yaml import CSafeLoader as _YamlLoader
+except ImportError:
+    from yaml import SafeLoader as _YamlLoader
+
+try:
+    import orjson
+
+    # Dates and dataclasses go through default=str, as with the standard library
+    _ORJSON_OPTIONS = orjson.OPT_INDENT_2 | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+
+    def dumps_json(obj: Any) -> str:
+        """Serialize to indented JSON with orjson (optional, faster)."""
+        try:
+            return orjson.dumps(obj, option=_ORJSON_OPTIONS, default=str).decode()
+        except orjson.JSONEncodeError:
+            # orjson rejects integers beyond 64 bits (e.g. NUMBER(38,0) values)
+            # and non-string dict keys, which the standard library handles
+            return json.dumps(obj, indent=2, default=str)
+except ImportError:
+    def dumps_json(obj: Any) -> str:
+        """Serialize to indented JSON with the standard library."""
+        return json.dumps(obj, indent=2, default=str)
+
+SQL_MODELS = ['llama3-8b', 'mistral-7b', 'snowflake-arctic']
+ANALYST_TABLES = ["ORDERS", "CUSTOMERS", "ORDER_ITEMS", "PRODUCTS", "PAYMENTS"]
+
+# Markdown fences and "SQL:"/"Query:" labels that models wrap around generated SQL
+_SQL_FENCE_RE = re.compile(r"\A\s*(?:(?:```(?:sql)?|SQL:|Query:)\s*)+|\s*```\s*\Z", re.IGNORECASE)
+
+# Table schemas rarely change, so lookups are cached for an hour, keyed by
+# (account, database, schema, table), as (fetched_at, columns).
+SCHEMA_CACHE_TTL_SECONDS = 3600
+_SCHEMA_CACHE: Dict[Tuple[str, str, str, str], Tuple[float, List[Dict[str, str]]]] = {}
+
+# Single connection shared by every call in this process; see snowflake_session().
+_CONNECTION: Optional[snowflake.connector.SnowflakeConnection] = None
+
+
+def _create_snowflake_connection() -> snowflake.connector.SnowflakeConnection:
+    """Open a new Snowflake connection from environment variables."""
+    account = os.getenv("SNOWFLAKE_ACCOUNT")
+    user = os.getenv("SNOWFLAKE_USER")
+    password = os.getenv("SNOWFLAKE_PASSWORD")
+    role = os.getenv("SNOWFLAKE_ROLE")
+    warehouse = os.getenv("SNOWFLAKE_WAREHOUSE")
+    database = os.getenv("SNOWFLAKE_DATABASE")
+    schema = os.getenv("SNOWFLAKE_SCHEMA")
+    
+    if not all([account, user, password, role, warehouse, database, schema]):
+        raise ValueError("Missing required Snowflake environment variables")
+    
+    return snowflake.connector.connect(
+        account=account,
+        user=user,
+        password=password,
+        role=role,
+        warehouse=warehouse,
+        database=database,
+        schema=schema,
+        client_session_keep_alive=True
+    )
+
+
+def get_snowflake_connection() -> snowflake.connector.SnowflakeConnection:
+    """Return the shared Snowflake connection, connecting on first use."""
+    global _CONNECTION
+    if _CONNECTION is None or _CONNECTION.is_closed():
+        _CONNECTION = _create_snowflake_connection()
+    return _CONNECTION
+
+
+def close_snowflake_connection() -> None:
+    """Close the shared Snowflake connection if it is open."""
+    global _CONNECTION
+    if _CONNECTION is not None and not _CONNECTION.is_closed():
+        _CONNECTION.close()
+    _CONNECTION = None
+
+
+atexit.register(close_snowflake_connection)
+
+
+@contextmanager
+def snowflake_session() -> Iterator[snowflake.connector.SnowflakeConnection]:
+    """
+    Yield the shared Snowflake connection after a health check.
+
+    The connection is pinged with SELECT 1 and transparently re-established
+    if the ping fails with a database error (dropped connection or expired
+    session token). It is left open on exit so later callers
+    skip the authentication handshake.
+    """
+    conn = get_snowflake_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1")
+    except snowflake.connector.errors.DatabaseError:
+        # OperationalError for dropped connections, ProgrammingError for an
+        # expired or invalid session token (e.g. 390112/390114)
+        close_snowflake_connection()
+        conn = get_snowflake_connection()
+    yield conn
+
+
+def load_relationships_yaml(yaml_path: str = "cortex_analyst_relationships.yaml") -> Dict[str, Any]:
+    """
+    Load the relationships YAML file.
+
+    The parsed content is mirrored to a ``.json`` sidecar next to the YAML;
+    while the sidecar is at least as new as the YAML it is read instead.
+    """
+    if not os.path.exists(yaml_path):
+        raise FileNotFoundError(f"Relationships YAML file not found: {yaml_path}")
+    
+    json_path = yaml_path + ".json"
+    if os.path.exists(json_path) and os.path.getmtime(json_path) >= os.path.getmtime(yaml_path):
+        try:
+            with open(json_path, 'r') as f:
+                return json.load(f)
+        except ValueError:
+            pass
+    
+    with open(yaml_path, 'r') as f:
+        data = yaml.load(f, Loader=_YamlLoader)
+    
+    try:
+        with open(json_path, 'w') as f:
+            json.dump(data, f)
+    except (OSError, TypeError):
+        pass
+    return data
+
+
+@dataclass(frozen=True)
+class RelationshipContext:
+    """Relationships YAML together with its prompt text, rendered once."""
+    yaml: Dict[str, Any]
+    rendered: str
+
+
+def render_relationships(relationships_yaml: Optional[Dict[str, Any]]) -> str:
+    """Render the "Table relationships" section of the SQL generation prompt."""
+    if not relationships_yaml:
+        return ""
+    lines = ["\nTable relationships:\n"]
+    for rel in relationships_yaml.get('relationships', []):
+        left_col = rel['relationshipColumns'][0]['leftColumn']
+        right_col = rel['relationshipColumns'][0]['rightColumn']
+        lines.append(f"- {rel['leftTable']}.{left_col} -> {rel['rightTable']}.{right_col} ({rel['relationshipType']})\n")
+    return "".join(lines)
+
+
+def load_relationship_context(yaml_path: str = "cortex_analyst_relationships.yaml") -> RelationshipContext:
+    """Load the relationships YAML and pre-render its prompt section."""
+    relationships_yaml = load_relationships_yaml(yaml_path)
+    return RelationshipContext(yaml=relationships_yaml, rendered=render_relationships(relationships_yaml))
+
+
+def as_relationship_context(
+    relationships: Optional[Any]
+) -> Optional[RelationshipContext]:
+    """Accept either a RelationshipContext or a raw relationships dict."""
+    if relationships is None or isinstance(relationships, RelationshipContext):
+        return relationships
+    return RelationshipContext(yaml=relationships, rendered=render_relationships(relationships))
+
+
+def build_sql_context(
+    prompt: str,
+    table_schemas: Dict[str, List[Dict[str, str]]],
+    relationships: Optional[RelationshipContext] = None
+) -> str:
+    """Build the SQL generation prompt for Cortex COMPLETE."""
+    parts = [
+        "You are a SQL expert for Snowflake. Generate a valid SQL query.\n\n",
+        "Available tables and their columns:\n",
+    ]
+    # Tables with identical column lists (e.g. date-sharded copies) are
+    # listed once and referenced by name afterwards.
+    seen_layouts: Dict[Tuple[Tuple[str, str], ...], str] = {}
+    for table, columns in table_schemas.items():
+        layout = tuple((col['name'], col['type']) for col in columns)
+        if layout in seen_layouts:
+            parts.append(f"\n{table}: same columns as {seen_layouts[layout]}\n")
+            continue
+        seen_layouts[layout] = table
+        parts.append(f"\n{table}:\n")
+        parts.extend(f"  - {col['name']} ({col['type']})\n" for col in columns)
+    
+    if relationships:
+        parts.append(relationships.rendered)
+    
+    parts.append(f"\nQuestion: {prompt}\n")
+    parts.append("Generate ONLY the SQL SELECT query. No explanations, no markdown, just SQL.")
+    return "".join(parts)
+
+
+def _describe_rows_to_columns(rows: List[tuple]) -> List[Dict[str, str]]:
+    """Convert DESCRIBE TABLE result rows into column dictionaries."""
+    columns = []
+    for row in rows:
+        columns.append({
+            "name": row[0],
+            "type": row[1],
+            "nullable": row[3] if len(row) > 3 else "Y",
+            "primary_key": row[5] if len(row) > 5 else "N"
+        })
+    return columns
+
+
+def _schema_cache_key(conn: snowflake.connector.SnowflakeConnection, table_name: str) -> Tuple[str, str, str, str]:
+    """Build the schema cache key for a table on the given connection."""
+    return (conn.account, conn.database, conn.schema, table_name.upper())
+
+
+def _cached_schema(key: Tuple[str, str, str, str]) -> Optional[List[Dict[str, str]]]:
+    """Return a cached schema younger than SCHEMA_CACHE_TTL_SECONDS, or None."""
+    cached = _SCHEMA_CACHE.get(key)
+    if cached and time.time() - cached[0] < SCHEMA_CACHE_TTL_SECONDS:
+        return cached[1]
+    return None
+
+
+def clear_schema_cache() -> None:
+    """Forget all cached table schemas so the next lookup re-describes them."""
+    _SCHEMA_CACHE.clear()
+
+
+def get_table_schema(conn: snowflake.connector.SnowflakeConnection, table_name: str) -> List[Dict[str, str]]:
+    """Get column information for a table."""
+    key = _schema_cache_key(conn, table_name)
+    cached = _cached_schema(key)
+    if cached is not None:
+        return cached
+
+    with conn.cursor() as cur:
+        try:
+            cur.execute(f"DESCRIBE TABLE {table_name}")
+            columns = _describe_rows_to_columns(cur.fetchall())
+            if columns:
+                _SCHEMA_CACHE[key] = (time.time(), columns)
+            return columns
+        except Exception as e:
+            print(f"   ⚠️  Could not get schema for {table_name}: {e}")
+            return []
+
+
+def _column_type(
+    data_type: str,
+    char_length: Optional[int],
+    precision: Optional[int],
+    scale: Optional[int],
+    datetime_precision: Optional[int]
+) -> str:
+    """Rebuild the DESCRIBE TABLE type (e.g. NUMBER(38,0), VARCHAR(100)) from INFORMATION_SCHEMA fields."""
+    if data_type == "NUMBER" and precision is not None:
+        return f"NUMBER({precision},{scale or 0})"
+    if data_type == "TEXT" and char_length is not None:
+        return f"VARCHAR({char_length})"
+    if data_type == "BINARY" and char_length is not None:
+        return f"BINARY({char_length})"
+    if data_type.startswith(("TIME", "TIMESTAMP")) and datetime_precision is not None:
+        return f"{data_type}({datetime_precision})"
+    return data_type
+
+
+def _primary_key_columns(conn: snowflake.connector.SnowflakeConnection) -> set:
+    """Return (TABLE_NAME, COLUMN_NAME) pairs of primary-key columns in the current schema."""
+    with conn.cursor() as cur:
+        cur.execute("SHOW PRIMARY KEYS IN SCHEMA")
+        names = [desc[0].lower() for desc in cur.description]
+        table_idx, column_idx = names.index("table_name"), names.index("column_name")
+        return {(row[table_idx], row[column_idx]) for row in cur.fetchall()}
+
+
+def fetch_all_schemas(
+    conn: snowflake.connector.SnowflakeConnection,
+    table_names: List[str]
+) -> Dict[str, List[Dict[str, str]]]:
+    """
+    Get column information for several tables with one INFORMATION_SCHEMA query.
+
+    Column types are rebuilt in DESCRIBE TABLE form and primary-key flags come
+    from SHOW PRIMARY KEYS, so the result matches get_table_schema(). Tables
+    that do not exist in the current schema are simply absent from the result.
+    Raises if either lookup fails, so callers can fall back to DESCRIBE TABLE.
+    """
+    if not table_names:
+        return {}
+    placeholders = ", ".join(["%s"] * len(table_names))
+    sql = (
+        "SELECT TABLE_NAME, COLUMN_NAME, DATA_TYPE, IS_NULLABLE, CHARACTER_MAXIMUM_LENGTH, "
+        "NUMERIC_PRECISION, NUMERIC_SCALE, DATETIME_PRECISION "
+        "FROM INFORMATION_SCHEMA.COLUMNS "
+        "WHERE TABLE_SCHEMA = CURRENT_SCHEMA() "
+        f"AND TABLE_NAME IN ({placeholders}) "
+        "ORDER BY TABLE_NAME, ORDINAL_POSITION"
+    )
+    primary_keys = _primary_key_columns(conn)
+    table_schemas: Dict[str, List[Dict[str, str]]] = defaultdict(list)
+    with conn.cursor() as cur:
+        cur.execute(sql, [name.upper() for name in table_names])
+        for (table_name, column_name, data_type, is_nullable, char_length,
+             precision, scale, datetime_precision) in cur.fetchall():
+            table_schemas[table_name].append({
+                "name": column_name,
+                "type": _column_type(data_type, char_length, precision, scale, datetime_precision),
+                "nullable": "Y" if is_nullable == "YES" else "N",
+                "primary_key": "Y" if (table_name, column_name) in primary_keys else "N"
+            })
+    return dict(table_schemas)
+
+
+def _describe_tables_async(
+    conn: snowflake.connector.SnowflakeConnection,
+    table_names: List[str]
+) -> Dict[str, List[Dict[str, str]]]:
+    """Run DESCRIBE TABLE for several tables as overlapping async queries."""
+    query_ids = {}
+    table_schemas = {}
+    with conn.cursor() as cur:
+        for table_name in table_names:
+            try:
+                cur.execute_async(f"DESCRIBE TABLE {table_name}")
+                query_ids[table_name] = cur.sfqid
+            except Exception as e:
+                print(f"   ⚠️  Could not get schema for {table_name}: {e}")
+
+        for table_name, query_id in query_ids.items():
+            try:
+                conn.get_query_status_throw_if_error(query_id)
+                cur.get_results_from_sfqid(query_id)
+                columns = _describe_rows_to_columns(cur.fetchall())
+                if columns:
+                    table_schemas[table_name] = columns
+            except Exception as e:
+                print(f"   ⚠️  Could not get schema for {table_name}: {e}")
+    return table_schemas
+
+
+def get_table_schemas(
+    conn: snowflake.connector.SnowflakeConnection,
+    table_names: List[str]
+) -> Dict[str, List[Dict[str, str]]]:
+    """
+    Get column information for several tables at once.
+
+    Tables in the schema cache (and younger than SCHEMA_CACHE_TTL_SECONDS)
+    are served from it. The rest are
+    looked up with a single INFORMATION_SCHEMA.COLUMNS query; if that fails,
+    DESCRIBE TABLE statements are submitted asynchronously instead so their
+    round-trips overlap.
+    """
+    table_schemas = {}
+    missing = []
+    for table_name in table_names:
+        cached = _cached_schema(_schema_cache_key(conn, table_name))
+        if cached is not None:
+            table_schemas[table_name] = cached
+        else:
+            missing.append(table_name)
+
+    if missing:
+        try:
+            fetched = fetch_all_schemas(conn, missing)
+            fetched = {name: fetched[name.upper()] for name in missing if name.upper() in fetched}
+        except Exception as e:
+            print(f"   ⚠️  INFORMATION_SCHEMA lookup failed, describing tables instead: {e}")
+            fetched = _describe_tables_async(conn, missing)
+        now = time.time()
+        for table_name, columns in fetched.items():
+            _SCHEMA_CACHE[_schema_cache_key(conn, table_name)] = (now, columns)
+            table_schemas[table_name] = columns
+    return {name: table_schemas[name] for name in table_names if name in table_schemas}
+
+
+def _nullable_integer_dtype(arrow_type: Any) -> Any:
+    """pyarrow types_mapper: keep integer columns as nullable pandas integers."""
+    import pandas as pd
+    import pyarrow as pa
+    if pa.types.is_signed_integer(arrow_type):
+        return pd.Int64Dtype()
+    if pa.types.is_unsigned_integer(arrow_type):
+        return pd.UInt64Dtype()
+    return None
+
+
+def format_frame(df) -> List[Dict[str, Any]]:
+    """
+    Format an Arrow-backed DataFrame into JSON-friendly row dictionaries.
+
+    Type coercion is decided once per column from its first non-null value
+    instead of being checked for every cell.
+    """
+    df = df.astype(object).where(df.notna(), None)
+    for col in df.columns:
+        values = df[col].dropna()
+        if values.empty:
+            continue
+        sample = values.iat[0]
+        if isinstance(sample, decimal.Decimal):
+            df[col] = df[col].map(lambda v: None if v is None else float(v))
+        elif not isinstance(sample, (str, int, float, bool)):
+            df[col] = df[col].map(lambda v: None if v is None else str(v))
+    # map() may re-infer numeric dtypes, turning None back into NaN
+    df = df.astype(object).where(df.notna(), None)
+    return df.to_dict(orient="records")
+
+
+def fetch_frame_records(cur: Any, max_rows: Optional[int] = None) -> Tuple[List[Dict[str, Any]], bool]:
+    """
+    Fetch a query result through the Arrow path as JSON-friendly row dictionaries.
+
+    Integer columns are read as nullable Int64/UInt64, so a column containing
+    NULLs keeps Python ints instead of turning into float64 (IDs would print
+    as 42.0 and values above 2**53 would lose precision). Batches are read
+    until ``max_rows`` rows are collected.
+
+    Returns:
+        Tuple of (rows, whether rows beyond max_rows were left unread)
+
+    Raises:
+        ImportError or NotSupportedError if the Arrow path is unavailable
+    """
+    rows: List[Dict[str, Any]] = []
+    for frame in cur.fetch_pandas_batches(types_mapper=_nullable_integer_dtype):
+        if max_rows is not None and len(frame) > max_rows - len(rows):
+            rows.extend(format_frame(frame.iloc[:max_rows - len(rows)]))
+            return rows, True
+        rows.extend(format_frame(frame))
+    return rows, False
+
+
+def clean_generated_sql(text: str) -> str:
+    """Strip markdown fences and labels from LLM-generated SQL."""
+    return _SQL_FENCE_RE.sub("", text).strip().rstrip(';')
+
+
+# The model name is passed as a parameter so the connector escapes it like any
+# other value (parameters are interpolated client-side, so Snowflake still sees
+# the model name in the SQL text)
+COMPLETE_SQL = "SELECT SNOWFLAKE.CORTEX.COMPLETE(%s, %s)"
+
+
+def _complete_serially(
+    conn: snowflake.connector.SnowflakeConnection,
+    context: str,
+    models: List[str]
+) -> Tuple[Optional[str], Optional[str]]:
+    """Try each model in turn and return the first non-empty completion."""
+    with conn.cursor() as cur:
+        for model in models:
+            try:
+                cur.execute(COMPLETE_SQL, (model, context))
+                result = cur.fetchone()
+                if result and result[0]:
+                    return result[0], model
+            except Exception:
+                continue
+    return None, None
+
+
+def _cancel_query(conn: snowflake.connector.SnowflakeConnection, query_id: str) -> None:
+    """Best-effort cancellation of a running query."""
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT SYSTEM$CANCEL_QUERY(%s)", (query_id,))
+    except Exception:
+        pass
+
+
+def race_async_queries(
+    conn: snowflake.connector.SnowflakeConnection,
+    queries: Sequence[Tuple[str, str, Sequence[Any]]],
+    fetch: Callable[[Any], Any],
+    poll_interval: float = 0.2,
+    timeout: float = 120.0
+) -> Tuple[Any, Optional[str]]:
+    """
+    Submit several queries asynchronously and keep the first usable result.
+
+    The queries run concurrently; as each finishes, ``fetch`` is called with
+    its cursor and returns the result, or None if it is unusable. The first
+    usable result wins and the queries still running are cancelled.
+
+    Args:
+        conn: Snowflake connection
+        queries: (label, sql, params) tuples
+        fetch: Reads a finished query's result from its cursor
+        poll_interval: Seconds between status checks
+        timeout: Seconds to wait before giving up
+
+    Returns:
+        Tuple of (result, label), or (None, None) if no query produced one
+
+    Raises:
+        Exception: If a query cannot be submitted (anything already
+            submitted is cancelled first)
+    """
+    pending: Dict[str, Tuple[str, Any]] = {}
+    try:
+        for label, sql, params in queries:
+            cur = conn.cursor()
+            cur.execute_async(sql, params)
+            pending[cur.sfqid] = (label, cur)
+    except Exception:
+        for query_id, (_, cur) in pending.items():
+            _cancel_query(conn, query_id)
+            cur.close()
+        raise
+
+    winner: Tuple[Any, Optional[str]] = (None, None)
+    deadline = time.monotonic() + timeout
+    try:
+        while pending and winner[0] is None and time.monotonic() < deadline:
+            for query_id, (label, cur) in list(pending.items()):
+                status = conn.get_query_status(query_id)
+                if conn.is_still_running(status):
+                    continue
+                del pending[query_id]
+                result = None
+                if not conn.is_an_error(status):
+                    try:
+                        cur.get_results_from_sfqid(query_id)
+                        result = fetch(cur)
+                    except Exception:
+                        result = None
+                cur.close()
+                if result is not None:
+                    winner = (result, label)
+                    break
+            else:
+                time.sleep(poll_interval)
+    finally:
+        for query_id, (_, cur) in pending.items():
+            _cancel_query(conn, query_id)
+            cur.close()
+    return winner
+
+
+def _first_value(cur: Any) -> Optional[Any]:
+    """Return the first column of the first row, or None if it is empty."""
+    row = cur.fetchone()
+    return row[0] if row and row[0] else None
+
+
+def race_cortex_complete(
+    conn: snowflake.connector.SnowflakeConnection,
+    context: str,
+    models: Optional[List[str]] = None,
+    poll_interval: float = 0.2,
+    timeout: float = 120.0,
+    width: Optional[int] = None
+) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Run Cortex COMPLETE on several models at once and keep the first answer.
+
+    The first ``width`` models (all of them by default) are submitted
+    asynchronously; the first query to succeed with a non-empty result wins
+    and the others are cancelled. If none of them answers, the remaining
+    models are tried one by one. Falls back to trying every model one by one
+    if async submission is not possible.
+
+    Returns:
+        Tuple of (completion text, model name), or (None, None)
+    """
+    models = models or SQL_MODELS
+    width = len(models) if width is None else width
+    queries = [
+        (model, COMPLETE_SQL, (model, context))
+        for model in models[:width]
+    ]
+    try:
+        winner = race_async_queries(conn, queries, _first_value, poll_interval, timeout)
+    except Exception:
+        return _complete_serially(conn, context, models)
+    if winner[0] is None and models[width:]:
+        winner = _complete_serially(conn, context, models[width:])
+    return winner
+
+
+def models_in_order(models: Sequence[str], preferred: Optional[str] = None) -> List[str]:
+    """Models in order of preference, with ``preferred`` (e.g. the last model that answered) first."""
+    if preferred is None:
+        return list(models)
+    return [preferred] + [model for model in models if model != preferred]
+
+
+def _complete_batch_query(model: str, indexed_prompts: Sequence[Tuple[int, str]]) -> Tuple[str, List[Any]]:
+    """Build the statement completing several prompts with one model."""
+    values = ", ".join(["(%s, %s)"] * len(indexed_prompts))
+    sql = (
+        "SELECT v.IDX, SNOWFLAKE.CORTEX.COMPLETE(%s, v.PROMPT) "
+        f"FROM (VALUES {values}) AS v(IDX, PROMPT)"
+    )
+    return sql, [model] + [value for pair in indexed_prompts for value in pair]
+
+
+def _answered_rows(cur: Any) -> Optional[Dict[int, str]]:
+    """Map prompt index to answer for the non-empty answers, or None if there are none."""
+    return {int(idx): text for idx, text in cur.fetchall() if text} or None
+
+
+def complete_batch(
+    conn: snowflake.connector.SnowflakeConnection,
+    prompts: Sequence[str],
+    models: Sequence[str],
+    speculate: int = 1
+) -> Tuple[List[Optional[str]], str]:
+    """
+    Run Cortex COMPLETE on several prompts with one statement per model.
+
+    The prompts are evaluated over a VALUES list, so N prompts cost one
+    round-trip per model instead of N. The first ``speculate`` models run
+    the batch concurrently and the first to answer wins; the remaining
+    models are then tried in order for the prompts still without an answer.
+
+    Returns:
+        Tuple of (answers in the order of ``prompts``, None where no model
+        answered; the first model that answered)
+
+    Raises:
+        Exception: If no model answered any prompt
+    """
+    answers: List[Optional[str]] = [None] * len(prompts)
+    answered_by: Optional[str] = None
+    last_error = None
+    remaining = list(models)
+
+    def pending() -> List[Tuple[int, str]]:
+        return [(i, prompt) for i, prompt in enumerate(prompts) if answers[i] is None]
+
+    def record(rows: Optional[Dict[int, str]], model: str) -> None:
+        nonlocal answered_by
+        for idx, text in (rows or {}).items():
+            answers[idx] = text
+        if rows and answered_by is None:
+            answered_by = model
+
+    raced = remaining[:speculate]
+    if len(raced) > 1:
+        todo = pending()
+        try:
+            rows, model = race_async_queries(
+                conn,
+                [(model, *_complete_batch_query(model, todo)) for model in raced],
+                _answered_rows,
+            )
+            if rows is None:
+                last_error = f"no answer from {', '.join(raced)}"
+                remaining = remaining[len(raced):]
+            else:
+                # The raced models that lost were cancelled, so they can
+                # still take the prompts the winner left unanswered
+                record(rows, model)
+                remaining = [other for other in remaining if other != model]
+        except Exception as e:
+            # Async submission unavailable; try every model in turn
+            last_error = str(e)
+
+    for model in remaining:
+        todo = pending()
+        if not todo:
+            break
+        try:
+            with conn.cursor() as cur:
+                cur.execute(*_complete_batch_query(model, todo))
+                record(_answered_rows(cur), model)
+        except Exception as e:
+            last_error = str(e)
+
+    if answered_by is None:
+        raise Exception(f"All models failed. Last error: {last_error}")
+    return answers, answered_by
@@ -1,86 +1,272 @@
+import csv
+import gzip
 import os
+import re
+import sys
+import tempfile
 import uuid
-from typing import List, Tuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from typing import Iterable, Iterator, List, Optional, Tuple, Union
 
 from pypdf import PdfReader
 
-from snowflake_connect import connect_snowflake
+from local_ann import invalidate_index_cache
+from snowflake_connect import connect_snowflake, pooled_conn
 
 
-def read_pdf_text(file_path: str) -> str:
+# Page-level extraction threads per PDF, and the smallest range worth a thread
+PAGE_WORKERS = int(os.getenv("PDF_PAGE_WORKERS", "4"))
+MIN_PAGES_PER_WORKER = 16
+
+# Any non-whitespace character; used to check whether text continues past a chunk
+_NON_SPACE_RE = re.compile(r"\S")
+
+
+def _extract_page(page) -> str:
+	try:
+		return page.extract_text() or ""
+	except Exception:
+		return ""
+
+
+def _extract_page_range(file_path: str, start: int, stop: int) -> List[str]:
+	# Each worker opens its own reader; a PdfReader's stream is not thread-safe
+	with open(file_path, "rb") as f:
+		reader = PdfReader(f)
+		return [_extract_page(reader.pages[i]) for i in range(start, stop)]
+
+
+def iter_pdf_pages(file_path: str, workers: int = PAGE_WORKERS) -> Iterator[str]:
+	"""
+	Yield the text of each page in order.
+
+	Long PDFs are split into contiguous page ranges extracted by a thread
+	pool (pypdf releases the GIL while inflating content streams); short ones
+	are read page by page.
+	"""
 	with open(file_path, "rb") as f:
 		reader = PdfReader(f)
-		text_parts: List[str] = []
-		for page in reader.pages:
-			try:
-				text_parts.append(page.extract_text() or "")
-			except Exception:
-				text_parts.append("")
-		return "\n".join(text_parts)
+		page_count = len(reader.pages)
+		if workers <= 1 or page_count < 2 * MIN_PAGES_PER_WORKER:
+			for page in reader.pages:
+				yield _extract_page(page)
+			return
+
+	step = max(MIN_PAGES_PER_WORKER, -(-page_count // workers))
+	with ThreadPoolExecutor(max_workers=workers) as extractors:
+		ranges = extractors.map(
+			lambda start: _extract_page_range(file_path, start, min(start + step, page_count)),
+			range(0, page_count, step),
+		)
+		for texts in ranges:
+			yield from texts
 
 
-def chunk_text(text: str, max_len: int = 1200, overlap: int = 150) -> List[str]:
-	text = text.replace("\x00", " ").strip()
-	if not text:
-		return []
+def read_pdf_text(file_path: str) -> str:
+	return "\n".join(iter_pdf_pages(file_path))
 
-	parts: List[str] = []
+
+def chunk_spans(text_len: int, max_len: int = 1200, overlap: int = 150) -> Iterator[Tuple[int, int]]:
+	"""Yield (start, end) offsets of overlapping chunks without slicing the text."""
 	start = 0
-	while start < len(text):
-		end = min(len(text), start + max_len)
-		chunk = text[start:end].strip()
-		if chunk:
-			parts.append(chunk)
-		if end == len(text):
+	while start < text_len:
+		end = min(text_len, start + max_len)
+		yield start, end
+		if end == text_len:
 			break
-		start = end - overlap
-		if start < 0:
-			start = 0
-	return parts
+		start = max(end - overlap, 0)
+
+
+def iter_chunks(pages: Iterable[str], max_len: int = 1200, overlap: int = 150) -> Iterator[str]:
+	"""
+	Chunk a stream of pages as if they were joined with newlines.
+
+	Only the unconsumed tail of the text is buffered: a chunk is emitted as
+	soon as non-whitespace text is known to follow it, and the buffer is then
+	advanced past it (keeping the overlap). Produces the same chunks as
+	chunk_text() on the fully joined document.
+	"""
+	buf = ""
+	started = False
+	for i, page in enumerate(pages):
+		piece = ("\n" if i else "") + page.replace("\x00", " ")
+		if not started:
+			# Leading whitespace of the whole document is dropped
+			piece = piece.lstrip()
+			started = bool(piece)
+		buf += piece
+
+		consumed = 0
+		for start, end in chunk_spans(len(buf), max_len, overlap):
+			if not _NON_SPACE_RE.search(buf, end):
+				break
+			chunk = buf[start:end].strip()
+			if chunk:
+				yield chunk
+			consumed = end - overlap
+		buf = buf[consumed:]
+
+	buf = buf.rstrip()
+	for start, end in chunk_spans(len(buf), max_len, overlap):
+		chunk = buf[start:end].strip()
+		if chunk:
+			yield chunk
+
+
+def chunk_text(text: Union[str, Iterable[str]], max_len: int = 1200, overlap: int = 150) -> List[str]:
+	"""Chunk a document given as one string or as an iterable of page texts."""
+	pages = [text] if isinstance(text, str) else text
+	return list(iter_chunks(pages, max_len, overlap))
+
+
+INSERT_BATCH_SIZE = 256
+
+ChunkRow = Tuple[str, str, int, str]
 
 
-def insert_chunk(conn, doc_id: str, filename: str, idx: int, content: str) -> None:
+def insert_chunks_batch(conn, rows: List[ChunkRow]) -> None:
+	"""Insert (doc_id, filename, chunk_index, content) rows with embeddings in one statement."""
+	if not rows:
+		return
+	values = ", ".join(["(%s, %s, %s, %s)"] * len(rows))
+	params = [value for row in rows for value in row]
 	with conn.cursor() as cur:
-		# Insert row without embedding first
+		# Embeddings are computed inline so each batch is a single round-trip
 		cur.execute(
-			"""
-			INSERT INTO PDF_DOC_CHUNKS (DOC_ID, FILENAME, CHUNK_INDEX, CONTENT)
-			VALUES (%s, %s, %s, %s)
+			f"""
+			INSERT INTO PDF_DOC_CHUNKS (DOC_ID, FILENAME, CHUNK_INDEX, CONTENT, EMBEDDING)
+			SELECT column1, column2, column3, column4,
+				SNOWFLAKE.CORTEX.EMBED_TEXT_768('e5-base-v2', column4)
+			FROM VALUES {values}
 			""",
-			(doc_id, filename, idx, content),
+			params,
+		)
+
+
+def parse_pdf_task(file_path: str) -> Tuple[str, List[str]]:
+	"""Extract and chunk one PDF page by page; runs in a worker process."""
+	return os.path.basename(file_path), chunk_text(iter_pdf_pages(file_path))
+
+
+def _insert_pooled(rows: List[ChunkRow]) -> int:
+	"""Insert one batch on a connection borrowed from the shared pool, so insert threads never share one."""
+	with pooled_conn() as conn:
+		insert_chunks_batch(conn, rows)
+	return len(rows)
+
+
+def bulk_load_chunks(conn, csv_path: str) -> None:
+	"""
+	Load a gzipped CSV of (doc_id, filename, chunk_index, content) rows via a stage.
+
+	The file is PUT to a temporary stage and COPY'd into a temporary table in
+	one bulk operation; embeddings are then computed set-based while moving
+	the rows into PDF_DOC_CHUNKS.
+	"""
+	file_url = "file://" + os.path.abspath(csv_path).replace("\\", "/")
+	with conn.cursor() as cur:
+		cur.execute(
+			"CREATE TEMPORARY STAGE IF NOT EXISTS PDF_CHUNKS_STAGE "
+			"FILE_FORMAT = (TYPE = CSV FIELD_OPTIONALLY_ENCLOSED_BY = '\"' COMPRESSION = GZIP)"
+		)
+		cur.execute(
+			"CREATE OR REPLACE TEMPORARY TABLE PDF_CHUNKS_LOAD "
+			"(DOC_ID STRING, FILENAME STRING, CHUNK_INDEX INTEGER, CONTENT STRING)"
+		)
+		cur.execute(f"PUT '{file_url}' @PDF_CHUNKS_STAGE AUTO_COMPRESS = FALSE OVERWRITE = TRUE")
+		cur.execute(
+			f"COPY INTO PDF_CHUNKS_LOAD FROM @PDF_CHUNKS_STAGE/{os.path.basename(csv_path)} PURGE = TRUE"
 		)
-		# Compute embedding in Snowflake and update row
 		cur.execute(
 			"""
-			UPDATE PDF_DOC_CHUNKS
-			SET EMBEDDING = SNOWFLAKE.CORTEX.EMBED_TEXT_768('e5-base-v2', CONTENT)
-			WHERE DOC_ID = %s AND CHUNK_INDEX = %s
-			""",
-			(doc_id, idx),
+			INSERT INTO PDF_DOC_CHUNKS (DOC_ID, FILENAME, CHUNK_INDEX, CONTENT, EMBEDDING)
+			SELECT DOC_ID, FILENAME, CHUNK_INDEX, CONTENT,
+				SNOWFLAKE.CORTEX.EMBED_TEXT_768('e5-base-v2', CONTENT)
+			FROM PDF_CHUNKS_LOAD
+			"""
 		)
 
 
-def ingest_folder(folder: str) -> Tuple[int, int]:
-	pdf_files = [f for f in os.listdir(folder) if f.lower().endswith(".pdf")]
+def _ingest_bulk(documents: Iterable[Tuple[str, List[str]]]) -> Tuple[int, int]:
+	"""Stream parsed documents into one gzipped CSV, then bulk load it."""
+	total_files = 0
 	total_chunks = 0
+	with tempfile.TemporaryDirectory() as tmp_dir:
+		csv_path = os.path.join(tmp_dir, "pdf_chunks.csv.gz")
+		with gzip.open(csv_path, "wt", newline="", encoding="utf-8") as f:
+			writer = csv.writer(f, quoting=csv.QUOTE_ALL)
+			for pdf, chunks in documents:
+				if not chunks:
+					continue
+				doc_id = str(uuid.uuid4())
+				writer.writerows((doc_id, pdf, idx, chunk) for idx, chunk in enumerate(chunks))
+				total_files += 1
+				total_chunks += len(chunks)
+		if total_chunks:
+			with connect_snowflake() as conn:
+				bulk_load_chunks(conn, csv_path)
+	return total_files, total_chunks
+
+
+def _ingest_batched(
+	documents: Iterable[Tuple[str, List[str]]],
+	batch_size: int,
+	insert_workers: int,
+) -> Tuple[int, int]:
+	"""Insert parsed documents in multi-row batches from a thread pool."""
 	total_files = 0
+	pending: List[ChunkRow] = []
+	futures = []
 
-	with connect_snowflake() as conn:
-		for pdf in pdf_files:
-			file_path = os.path.join(folder, pdf)
-			text = read_pdf_text(file_path)
-			chunks = chunk_text(text)
+	# Batches are submitted as soon as they fill so parsing and inserts overlap
+	with ThreadPoolExecutor(max_workers=insert_workers) as inserters:
+		for pdf, chunks in documents:
 			if not chunks:
 				continue
 
 			doc_id = str(uuid.uuid4())
 			for idx, chunk in enumerate(chunks):
-				insert_chunk(conn, doc_id, pdf, idx, chunk)
-				total_chunks += 1
+				pending.append((doc_id, pdf, idx, chunk))
+				if len(pending) >= batch_size:
+					futures.append(inserters.submit(_insert_pooled, pending))
+					pending = []
 			total_files += 1
+		if pending:
+			futures.append(inserters.submit(_insert_pooled, pending))
+
+		total_chunks = sum(f.result() for f in as_completed(futures))
 	return total_files, total_chunks
 
 
+def ingest_folder(
+	folder: str,
+	batch_size: int = INSERT_BATCH_SIZE,
+	parse_workers: Optional[int] = None,
+	insert_workers: int = 8,
+	bulk: bool = False,
+) -> Tuple[int, int]:
+	"""
+	Parse every PDF in a folder and load its chunks with embeddings.
+
+	PDF parsing is CPU-bound and runs in worker processes. By default chunks
+	are inserted in batches from a thread pool; with bulk=True (better for
+	large libraries) they are staged as one compressed CSV and loaded with
+	PUT + COPY INTO.
+	"""
+	pdf_files = [
+		os.path.join(folder, f) for f in os.listdir(folder) if f.lower().endswith(".pdf")
+	]
+	try:
+		with ProcessPoolExecutor(max_workers=parse_workers or os.cpu_count()) as parsers:
+			documents = parsers.map(parse_pdf_task, pdf_files)
+			if bulk:
+				return _ingest_bulk(documents)
+			return _ingest_batched(documents, batch_size, insert_workers)
+	finally:
+		# The local retrieval mirror no longer matches the table
+		invalidate_index_cache()
+
+
 if __name__ == "__main__":
 	# Support both 'pdf_data' and 'PDF Data'
 	cwd = os.getcwd()
@@ -92,6 +278,6 @@ if __name__ == "__main__":
 	if not target_folder:
 		print(f"Folder not found. Checked: {', '.join(candidates)}")
 	else:
-		files, chunks = ingest_folder(target_folder)
+		files, chunks = ingest_folder(target_folder, bulk="--bulk" in sys.argv[1:])
 		print(f"Ingested {files} PDFs into {chunks} chunks from: {target_folder}")
 
@@ -0,0 +1,233 @@
+"""
+Local in-process vector index mirroring PDF_DOC_CHUNKS.
+
+When the USE_LOCAL_ANN environment variable is set, retrieve_context() ranks
+chunks against this in-memory copy of the embeddings (one numpy matrix
+product) instead of having Snowflake scan every row per question. Only the
+question embedding is still computed in Snowflake.
+
+The mirror is cached on disk next to the app and reloaded from Snowflake when
+the table's contents change (its row count and a HASH_AGG over the chunks are
+compared every few minutes); ingestion also deletes the cache in its own
+process. Embeddings are held as int8 codes with one float scale per row
+(768 bytes per chunk instead of 3 KB), which keeps large corpora in memory at
+a negligible cost in ranking accuracy.
+"""
+
+import json
+import os
+import threading
+import time
+from typing import Any, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+INDEX_CACHE_PATH = ".rag_ann_index"
+# How often (seconds) to compare the mirror against the table's row count
+REFRESH_INTERVAL_SECONDS = 300
+EMBEDDING_DIM = 768
+# Rows dequantized per step when scoring, bounding the float32 scratch space
+SEARCH_BLOCK_ROWS = 8192
+
+
+def local_ann_enabled() -> bool:
+    """Whether retrieval should use the local index (USE_LOCAL_ANN=1/true/yes)."""
+    return os.getenv("USE_LOCAL_ANN", "").strip().lower() in ("1", "true", "yes")
+
+
+def _as_vector(value: Any) -> np.ndarray:
+    """Convert a VECTOR value (list, or JSON text on older connectors) to float32."""
+    if isinstance(value, str):
+        value = json.loads(value)
+    return np.asarray(value, dtype=np.float32)
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def quantize_rows(matrix: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Symmetric per-row int8 quantization.
+
+    Returns:
+        Tuple of (int8 codes, float32 scales) with row ~= codes * scale
+    """
+    scales = np.abs(matrix).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    codes = np.rint(matrix / scales[:, np.newaxis]).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+class LocalVectorIndex:
+    """
+    Brute-force cosine index over int8-quantized, unit-normalized embeddings.
+
+    Rows are normalized and quantized once at build time, so similarity for a
+    query is a matrix-vector product over the codes, rescaled per row; it
+    closely tracks VECTOR_COSINE_SIMILARITY.
+    """
+
+    def __init__(
+        self,
+        codes: np.ndarray,
+        scales: np.ndarray,
+        filenames: Sequence[str],
+        chunk_indexes: Sequence[int],
+        contents: Sequence[str],
+        fingerprint: Optional[str] = None
+    ):
+        self.codes = codes
+        self.scales = scales
+        self.filenames = list(filenames)
+        self.chunk_indexes = list(chunk_indexes)
+        self.contents = list(contents)
+        # table_fingerprint() of PDF_DOC_CHUNKS when the mirror was built
+        self.fingerprint = fingerprint
+
+    def __len__(self) -> int:
+        return len(self.contents)
+
+    @classmethod
+    def from_snowflake(cls, cur: Any) -> "LocalVectorIndex":
+        """Mirror every chunk and its embedding from PDF_DOC_CHUNKS."""
+        cur.execute("SELECT FILENAME, CHUNK_INDEX, CONTENT, EMBEDDING FROM PDF_DOC_CHUNKS")
+        rows = [row for row in cur.fetchall() if row[3] is not None]
+        embeddings = (
+            np.stack([_as_vector(row[3]) for row in rows])
+            if rows else np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+        )
+        codes, scales = quantize_rows(_normalize_rows(embeddings))
+        return cls(
+            codes,
+            scales,
+            [row[0] for row in rows],
+            [row[1] for row in rows],
+            [row[2] for row in rows],
+        )
+
+    def save(self, path: str = INDEX_CACHE_PATH) -> None:
+        """Write the quantized embeddings (.npz) and chunk metadata (.json) to disk."""
+        np.savez(path + ".npz", codes=self.codes, scales=self.scales)
+        with open(path + ".json", "w", encoding="utf-8") as f:
+            json.dump({
+                "filenames": self.filenames,
+                "chunk_indexes": self.chunk_indexes,
+                "contents": self.contents,
+                "fingerprint": self.fingerprint,
+            }, f)
+
+    @classmethod
+    def load(cls, path: str = INDEX_CACHE_PATH) -> Optional["LocalVectorIndex"]:
+        """Read an index saved by save(), or None if there is no usable cache."""
+        try:
+            with np.load(path + ".npz") as arrays:
+                codes, scales = arrays["codes"], arrays["scales"]
+            with open(path + ".json", "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, ValueError, KeyError):
+            return None
+        return cls(
+            codes, scales, meta["filenames"], meta["chunk_indexes"], meta["contents"],
+            meta.get("fingerprint"),
+        )
+
+    def search(self, query_vector: np.ndarray, k: int = 5) -> List[Tuple[str, str, int, float]]:
+        """
+        Return the k most similar chunks.
+
+        Returns:
+            List of (content, filename, chunk_index, similarity), best first
+        """
+        if not len(self) or k <= 0:
+            return []
+        query = np.asarray(query_vector, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm:
+            query = query / norm
+        sims = np.empty(len(self), dtype=np.float32)
+        for start in range(0, len(self), SEARCH_BLOCK_ROWS):
+            block = self.codes[start:start + SEARCH_BLOCK_ROWS]
+            sims[start:start + len(block)] = block.astype(np.float32) @ query
+        sims *= self.scales
+        if k < len(sims):
+            top = np.argpartition(-sims, k - 1)[:k]
+        else:
+            top = np.arange(len(sims))
+        top = top[np.argsort(-sims[top])]
+        return [
+            (self.contents[i], self.filenames[i], self.chunk_indexes[i], float(sims[i]))
+            for i in top
+        ]
+
+
+_INDEX: Optional[LocalVectorIndex] = None
+_INDEX_CHECKED_AT = 0.0
+_INDEX_LOCK = threading.Lock()
+
+
+def invalidate_index_cache(path: str = INDEX_CACHE_PATH) -> None:
+    """Forget the in-memory mirror and delete the on-disk cache."""
+    global _INDEX
+    with _INDEX_LOCK:
+        _INDEX = None
+    for suffix in (".npz", ".json"):
+        try:
+            os.remove(path + suffix)
+        except OSError:
+            pass
+
+
+def table_fingerprint(cur: Any) -> str:
+    """
+    Summarize the indexed rows of PDF_DOC_CHUNKS.
+
+    Combines the row count with HASH_AGG over filename, chunk index and
+    content, so replacing chunks with the same number of new ones is detected.
+    """
+    cur.execute(
+        "SELECT COUNT(*), HASH_AGG(FILENAME, CHUNK_INDEX, CONTENT) "
+        "FROM PDF_DOC_CHUNKS WHERE EMBEDDING IS NOT NULL"
+    )
+    row_count, content_hash = cur.fetchone()
+    return f"{row_count}:{content_hash}"
+
+
+def get_local_index(cur: Any) -> LocalVectorIndex:
+    """
+    Return the process-wide index, loading or refreshing it as needed.
+
+    The cached copy is trusted for REFRESH_INTERVAL_SECONDS; after that the
+    table's fingerprint is compared and the mirror rebuilt if it changed.
+    """
+    global _INDEX, _INDEX_CHECKED_AT
+    with _INDEX_LOCK:
+        now = time.monotonic()
+        if _INDEX is not None and now - _INDEX_CHECKED_AT < REFRESH_INTERVAL_SECONDS:
+            return _INDEX
+
+        index = _INDEX or LocalVectorIndex.load()
+        # Taken before reading the rows, so a concurrent change makes the next
+        # check rebuild again rather than go unnoticed
+        fingerprint = table_fingerprint(cur)
+        if index is None or index.fingerprint != fingerprint:
+            index = LocalVectorIndex.from_snowflake(cur)
+            index.fingerprint = fingerprint
+            try:
+                index.save()
+            except OSError as e:
+                print(f"Could not save local ANN index: {e}")
+
+        _INDEX = index
+        _INDEX_CHECKED_AT = now
+        return index
+
+
+def search_local(cur: Any, question: str, k: int = 5) -> List[Tuple[str, str, int, float]]:
+    """Embed the question in Snowflake and rank chunks against the local index."""
+    index = get_local_index(cur)
+    cur.execute("SELECT SNOWFLAKE.CORTEX.EMBED_TEXT_768('e5-base-v2', %s)", (question,))
+    (query_vector,) = cur.fetchone()
+    return index.search(_as_vector(query_vector), k)
@@ -3,33 +3,23 @@ Orchestrator LLM Module
 Routes user queries to Cortex Analyst (structured data) or RAG (unstructured PDFs)
 """
 
-from typing import Dict, Any, Optional, Literal
+from typing import Dict, Any, Optional, Literal, Callable, Sequence
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from openai import AzureOpenAI
+import numpy as np
+import io
 import json
 import os
+import re
+import threading
 
 
-class QueryOrchestrator:
-    """
-    Orchestrator that uses EPAM DIAL LLM to route queries to appropriate systems.
-    """
-    
-    def __init__(self, api_key: str = None):
-        """
-        Initialize the orchestrator with EPAM DIAL API.
-        
-        Args:
-            api_key: EPAM DIAL API key. If None, reads from environment variable DIAL_API_KEY
-        """
-        self.api_key = api_key or os.getenv("DIAL_API_KEY", "dial-j7r9nwg4xmk9spkibd3xrp4hjdg")
-        
-        self.client = AzureOpenAI(
-            api_version="2023-12-01-preview",
-            azure_endpoint="https://chat.epam.com",
-            api_key=self.api_key
-        )
-        
-        self.routing_prompt = """You are an intelligent query router. Analyze the user's question and determine which system(s) should handle it.
+VALID_ROUTES = ("CORTEX_ANALYST", "RAG", "BOTH")
+ROUTE_CACHE_SIZE = 2048
+SEMANTIC_CACHE_THRESHOLD = 0.95
+
+ROUTING_SYSTEM_PROMPT = """You are an intelligent query router. Analyze the user's question and determine which system(s) should handle it.
 
 Available systems:
 1. CORTEX_ANALYST - For analytical queries about structured data (orders, customers, products, payments, order items). Examples:
@@ -54,7 +44,102 @@ Respond ONLY with a JSON object in this exact format:
   "reasoning": "Brief explanation of why this route was chosen"
 }
 
-User question: {question}"""
+The user message contains only the question to route."""
+
+# Keywords for structured data queries
+ANALYTICS_KEYWORDS = (
+    "customer", "order", "product", "payment", "revenue", "sales",
+    "total", "sum", "count", "average", "top", "highest", "lowest",
+    "by", "group", "aggregate", "database", "table"
+)
+
+# Keywords for document queries
+DOCUMENT_KEYWORDS = (
+    "report", "document", "pdf", "sustainability", "earnings",
+    "transcript", "statement", "findings", "mentioned", "says",
+    "according to", "in the document", "in the report"
+)
+
+
+def _keyword_pattern(keywords: Sequence[str]) -> "re.Pattern":
+    """
+    Compile keywords into one pattern that finds every occurrence in a single scan.
+    
+    The alternation sits in a lookahead so overlapping keywords
+    ("report" inside "in the report") are all reported, as with substring tests.
+    """
+    alternation = "|".join(re.escape(k) for k in sorted(keywords, key=len, reverse=True))
+    return re.compile(f"(?=({alternation}))")
+
+
+_ANALYTICS_KEYWORDS_RE = _keyword_pattern(ANALYTICS_KEYWORDS)
+_DOCUMENT_KEYWORDS_RE = _keyword_pattern(DOCUMENT_KEYWORDS)
+
+
+_JSON_DECODER = json.JSONDecoder()
+
+
+def extract_json_object(text: str) -> Dict[str, Any]:
+    """
+    Decode the first JSON object embedded in text.
+    
+    Each "{" is tried in turn with a single forward raw_decode pass, so
+    surrounding prose or code fences are ignored without regex backtracking.
+    
+    Raises:
+        ValueError: If the text contains no JSON object
+    """
+    start = text.find("{")
+    while start != -1:
+        try:
+            obj, _end = _JSON_DECODER.raw_decode(text, start)
+            return obj
+        except ValueError:
+            start = text.find("{", start + 1)
+    raise ValueError("No JSON object in LLM response")
+
+
+def normalize_question(question: str) -> str:
+    """Normalize a question for exact-match route caching."""
+    return " ".join(question.lower().split())
+
+
+class QueryOrchestrator:
+    """
+    Orchestrator that uses EPAM DIAL LLM to route queries to appropriate systems.
+    """
+    
+    def __init__(self, api_key: str = None, embed_func: Optional[Callable[[str], Sequence[float]]] = None):
+        """
+        Initialize the orchestrator with EPAM DIAL API.
+        
+        Args:
+            api_key: EPAM DIAL API key. If None, reads from environment variable DIAL_API_KEY
+            embed_func: Optional callable returning an embedding for a question
+                (e.g. Snowflake EMBED_TEXT_768). Enables the semantic route cache.
+        """
+        self.api_key = api_key or os.getenv("DIAL_API_KEY", "dial-j7r9nwg4xmk9spkibd3xrp4hjdg")
+        
+        self.client = AzureOpenAI(
+            api_version="2023-12-01-preview",
+            azure_endpoint="https://chat.epam.com",
+            api_key=self.api_key
+        )
+        
+        # The routing instructions never change, so they form a fixed system
+        # message (a cacheable prompt prefix); each request adds only the question
+        self.system_message = {"role": "system", "content": ROUTING_SYSTEM_PROMPT}
+        
+        # Exact-match LRU cache keyed on the normalized question. Failed LLM
+        # calls raise, so keyword fallbacks are never cached. The lock also
+        # guards the semantic cache, as one orchestrator serves several threads.
+        self._route_cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._route_cache_lock = threading.Lock()
+        
+        # Semantic cache: unit-norm embeddings of past questions and their routes
+        self.embed_func = embed_func
+        self._semantic_vectors: Optional[np.ndarray] = None
+        self._semantic_routes: list = []
     
     def route_query(self, question: str) -> Dict[str, Any]:
         """
@@ -72,63 +157,142 @@ User question: {question}"""
             }
         """
         try:
-            messages = [
-                {
-                    "role": "system",
-                    "content": "You are a query routing assistant. Respond only with valid JSON."
-                },
-                {
-                    "role": "user",
-                    "content": self.routing_prompt.format(question=question)
-                }
-            ]
-            
-            response = self.client.chat.completions.create(
-                model="gpt-4",
-                messages=messages,
-                temperature=0.1,  # Low temperature for consistent routing
-                max_tokens=200
-            )
-            
-            # Extract response
-            content = response.choices[0].message.content.strip()
-            
-            # Try to parse JSON from response
-            # Sometimes LLM wraps JSON in markdown code blocks
-            if "```json" in content:
-                content = content.split("```json")[1].split("```")[0].strip()
-            elif "```" in content:
-                content = content.split("```")[1].split("```")[0].strip()
-            
-            # Try to extract JSON object
-            import re
-            json_match = re.search(r'\{[^{}]*(?:\{[^{}]*\}[^{}]*)*\}', content, re.DOTALL)
-            if json_match:
-                try:
-                    routing_decision = json.loads(json_match.group())
-                except json.JSONDecodeError:
-                    routing_decision = self._fallback_routing(question)
-            else:
-                try:
-                    routing_decision = json.loads(content)
-                except json.JSONDecodeError:
-                    # Fallback routing based on keywords
-                    routing_decision = self._fallback_routing(question)
-            
-            # Validate route
-            route = routing_decision.get("route", "").upper()
-            if route not in ["CORTEX_ANALYST", "RAG", "BOTH"]:
-                routing_decision = self._fallback_routing(question)
-            
-            routing_decision["confidence"] = 0.9 if route in ["CORTEX_ANALYST", "RAG", "BOTH"] else 0.5
-            
-            return routing_decision
-            
+            return dict(self._cached_route(question))
         except Exception as e:
             print(f"Orchestrator error: {e}")
             # Fallback to keyword-based routing
             return self._fallback_routing(question)
     
+    def _cached_route(self, question: str) -> Dict[str, Any]:
+        """
+        Route a question, reusing the decision for an identical normalized question.
+        
+        Only the cache key is normalized; the original question (with its
+        casing, acronyms and product codes) is what gets routed.
+        """
+        key = normalize_question(question)
+        with self._route_cache_lock:
+            if key in self._route_cache:
+                self._route_cache.move_to_end(key)
+                return self._route_cache[key]
+        
+        decision = self._route_uncached(question)
+        with self._route_cache_lock:
+            self._route_cache[key] = decision
+            self._route_cache.move_to_end(key)
+            while len(self._route_cache) > ROUTE_CACHE_SIZE:
+                self._route_cache.popitem(last=False)
+        return decision
+    
+    def _route_uncached(self, question: str) -> Dict[str, Any]:
+        """
+        Route a question via the semantic cache, then the LLM.
+        
+        Raises on API errors and when no valid route can be parsed, so
+        that only genuine routing decisions end up in the exact-match cache.
+        """
+        vector = self._embed(question)
+        cached = self._semantic_lookup(question, vector)
+        if cached is not None:
+            return cached
+        
+        routing_decision = self._route_with_llm(question)
+        self._semantic_store(vector, routing_decision)
+        return routing_decision
+    
+    def _route_with_llm(self, question: str) -> Dict[str, Any]:
+        """Ask the LLM for a routing decision."""
+        messages = [
+            self.system_message,
+            {"role": "user", "content": question}
+        ]
+        
+        response = self.client.chat.completions.create(
+            model="gpt-4",
+            messages=messages,
+            temperature=0.1,  # Low temperature for consistent routing
+            max_tokens=200
+        )
+        
+        # Extract response
+        content = response.choices[0].message.content.strip()
+        
+        # Parse the first JSON object in the response; this also skips any
+        # markdown code fence the LLM wraps around it
+        routing_decision = extract_json_object(content)
+        
+        # Validate route
+        route = str(routing_decision.get("route", "")).upper()
+        if route not in VALID_ROUTES:
+            raise ValueError(f"Invalid route from LLM: {route!r}")
+        
+        routing_decision["route"] = route
+        routing_decision["confidence"] = 0.9
+        return routing_decision
+    
+    def _embed(self, question: str) -> Optional[np.ndarray]:
+        """Return a unit-norm embedding for the question, or None if unavailable."""
+        if self.embed_func is None:
+            return None
+        try:
+            vector = np.asarray(self.embed_func(question), dtype=np.float32)
+        except Exception as e:
+            print(f"Embedding error: {e}")
+            return None
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else None
+    
+    def _semantic_lookup(self, question: str, vector: Optional[np.ndarray]) -> Optional[Dict[str, Any]]:
+        """Reuse the route of a near-duplicate question if it passes the judge step."""
+        if vector is None:
+            return None
+        
+        with self._route_cache_lock:
+            if self._semantic_vectors is None:
+                return None
+            similarities = self._semantic_vectors @ vector
+            best = int(np.argmax(similarities))
+            if similarities[best] < SEMANTIC_CACHE_THRESHOLD:
+                return None
+            decision = self._semantic_routes[best]
+        
+        if not self._judge_cached_route(question, decision["route"]):
+            return None
+        return dict(decision, reasoning=f"{decision.get('reasoning', '')} (semantic cache)".strip())
+    
+    def _semantic_store(self, vector: Optional[np.ndarray], decision: Dict[str, Any]) -> None:
+        """Remember a routing decision for future near-duplicate questions."""
+        if vector is None:
+            return
+        with self._route_cache_lock:
+            if self._semantic_vectors is None:
+                self._semantic_vectors = vector[np.newaxis, :]
+            else:
+                self._semantic_vectors = np.vstack([self._semantic_vectors, vector])[-ROUTE_CACHE_SIZE:]
+            self._semantic_routes = (self._semantic_routes + [dict(decision)])[-ROUTE_CACHE_SIZE:]
+    
+    def _judge_cached_route(self, question: str, route: str) -> bool:
+        """
+        Cheap sanity check before trusting a semantically cached route.
+        
+        Rejects the cached route when the question's keywords point only at the
+        other system (e.g. a cached RAG route for a question with only
+        analytics keywords).
+        """
+        analytics_score, document_score = self._keyword_scores(question)
+        if route == "CORTEX_ANALYST":
+            return not (document_score > 0 and analytics_score == 0)
+        if route == "RAG":
+            return not (analytics_score > 0 and document_score == 0)
+        return True
+    
+    def clear_route_cache(self) -> None:
+        """Drop all cached routing decisions."""
+        with self._route_cache_lock:
+            self._route_cache.clear()
+            self._semantic_vectors = None
+            self._semantic_routes = []
+    
     def execute_query(
         self,
         question: str,
@@ -153,59 +317,76 @@ User question: {question}"""
         route = routing.get("route", "RAG")
         
         results = {}
-        combined_response_parts = []
+        run_analyst = route in ("CORTEX_ANALYST", "BOTH") and cortex_analyst_func is not None
+        run_rag = route in ("RAG", "BOTH") and rag_query_func is not None
+        
+        # The combined response is written into one buffer as sections complete
+        response = io.StringIO()
+        separator = "\n\n"
+        if run_analyst and run_rag:
+            response.write("## Combined Results\n\n")
+            separator = "\n\n---\n\n"
+        header_len = response.tell()
+        
+        def start_section() -> None:
+            if response.tell() > header_len:
+                response.write(separator)
+        
+        # The two systems are independent network-bound calls, so for BOTH the
+        # RAG query runs in a worker thread while Cortex Analyst runs here
+        rag_future = None
+        if run_analyst and run_rag:
+            executor = ThreadPoolExecutor(max_workers=1)
+            rag_future = executor.submit(rag_query_func, question)
+            executor.shutdown(wait=False)
         
         # Execute based on route
-        if route == "CORTEX_ANALYST" or route == "BOTH":
-            if cortex_analyst_func:
-                try:
-                    cortex_result = cortex_analyst_func(question)
-                    results["cortex_analyst"] = cortex_result
-                    
-                    if cortex_result.get("success"):
-                        # Format Cortex Analyst response
-                        if cortex_result.get("results"):
-                            combined_response_parts.append("## Analytics Results\n\n")
-                            
-                            # Create a summary
-                            row_count = cortex_result.get("row_count", 0)
-                            combined_response_parts.append(f"Found {row_count} result(s).\n\n")
-                            
-                            # Show first few results as text
-                            for i, row in enumerate(cortex_result["results"][:5], 1):
-                                row_text = ", ".join([f"{k}: {v}" for k, v in row.items()])
-                                combined_response_parts.append(f"{i}. {row_text}\n")
-                            
-                            if row_count > 5:
-                                combined_response_parts.append(f"\n... and {row_count - 5} more results (see Analytics Results below)")
-                        else:
-                            combined_response_parts.append("Analytics query completed but returned no results.")
-                    else:
-                        combined_response_parts.append(f"Analytics query error: {cortex_result.get('error', 'Unknown error')}")
-                except Exception as e:
-                    results["cortex_analyst"] = {"error": str(e), "success": False}
-                    combined_response_parts.append(f"Analytics query failed: {str(e)}")
-        
-        if route == "RAG" or route == "BOTH":
-            if rag_query_func:
-                try:
-                    rag_result = rag_query_func(question)
-                    results["rag"] = rag_result
-                    
-                    if rag_result.get("success"):
-                        combined_response_parts.append(rag_result.get("answer", "No answer generated"))
+        if run_analyst:
+            start_section()
+            try:
+                cortex_result = cortex_analyst_func(question)
+                results["cortex_analyst"] = cortex_result
+                
+                if cortex_result.get("success"):
+                    # Format Cortex Analyst response
+                    if cortex_result.get("results"):
+                        response.write("## Analytics Results\n\n")
+                        
+                        # Create a summary
+                        row_count = cortex_result.get("row_count", 0)
+                        response.write(f"Found {row_count} result(s).\n\n")
+                        
+                        # Show first few results as text
+                        for i, row in enumerate(cortex_result["results"][:5], 1):
+                            row_text = ", ".join([f"{k}: {v}" for k, v in row.items()])
+                            response.write(f"{i}. {row_text}\n")
+                        
+                        if row_count > 5:
+                            response.write(f"\n... and {row_count - 5} more results (see Analytics Results below)")
                     else:
-                        combined_response_parts.append(f"Document query error: {rag_result.get('error', 'Unknown error')}")
-                except Exception as e:
-                    results["rag"] = {"error": str(e), "success": False}
-                    combined_response_parts.append(f"Document query failed: {str(e)}")
-        
-        # Combine responses
-        if route == "BOTH" and len(combined_response_parts) > 1:
-            combined_response = "\n\n---\n\n".join(combined_response_parts)
-            combined_response = f"## Combined Results\n\n{combined_response}"
-        elif combined_response_parts:
-            combined_response = "\n\n".join(combined_response_parts)
+                        response.write("Analytics query completed but returned no results.")
+                else:
+                    response.write(f"Analytics query error: {cortex_result.get('error', 'Unknown error')}")
+            except Exception as e:
+                results["cortex_analyst"] = {"error": str(e), "success": False}
+                response.write(f"Analytics query failed: {str(e)}")
+        
+        if run_rag:
+            start_section()
+            try:
+                rag_result = rag_future.result() if rag_future is not None else rag_query_func(question)
+                results["rag"] = rag_result
+                
+                if rag_result.get("success"):
+                    response.write(rag_result.get("answer", "No answer generated"))
+                else:
+                    response.write(f"Document query error: {rag_result.get('error', 'Unknown error')}")
+            except Exception as e:
+                results["rag"] = {"error": str(e), "success": False}
+                response.write(f"Document query failed: {str(e)}")
+        
+        if response.tell():
+            combined_response = response.getvalue()
         else:
             combined_response = "No results generated. Please try rephrasing your question."
         
@@ -228,6 +409,21 @@ User question: {question}"""
             "combined_response": combined_response
         }
     
+    def _keyword_scores(self, question: str) -> tuple:
+        """
+        Count analytics and document keywords in a question.
+        
+        Args:
+            question: User's question
+            
+        Returns:
+            Tuple of (analytics_score, document_score)
+        """
+        question_lower = question.lower()
+        analytics_score = len({m.group(1) for m in _ANALYTICS_KEYWORDS_RE.finditer(question_lower)})
+        document_score = len({m.group(1) for m in _DOCUMENT_KEYWORDS_RE.finditer(question_lower)})
+        return analytics_score, document_score
+    
     def _fallback_routing(self, question: str) -> Dict[str, Any]:
         """
         Fallback routing based on keywords if LLM fails.
@@ -238,24 +434,7 @@ User question: {question}"""
         Returns:
             Routing decision dictionary
         """
-        question_lower = question.lower()
-        
-        # Keywords for structured data queries
-        analytics_keywords = [
-            "customer", "order", "product", "payment", "revenue", "sales",
-            "total", "sum", "count", "average", "top", "highest", "lowest",
-            "by", "group", "aggregate", "database", "table"
-        ]
-        
-        # Keywords for document queries
-        document_keywords = [
-            "report", "document", "pdf", "sustainability", "earnings",
-            "transcript", "statement", "findings", "mentioned", "says",
-            "according to", "in the document", "in the report"
-        ]
-        
-        analytics_score = sum(1 for keyword in analytics_keywords if keyword in question_lower)
-        document_score = sum(1 for keyword in document_keywords if keyword in question_lower)
+        analytics_score, document_score = self._keyword_scores(question)
         
         if analytics_score > document_score and analytics_score > 0:
             route = "CORTEX_ANALYST"
@@ -278,17 +457,21 @@ User question: {question}"""
         }
 
 
-def create_orchestrator(api_key: str = None) -> QueryOrchestrator:
+def create_orchestrator(
+    api_key: str = None,
+    embed_func: Optional[Callable[[str], Sequence[float]]] = None
+) -> QueryOrchestrator:
     """
     Factory function to create an orchestrator instance.
     
     Args:
         api_key: Optional API key. If None, uses default or environment variable.
+        embed_func: Optional question embedder enabling the semantic route cache.
         
     Returns:
         QueryOrchestrator instance
     """
-    return QueryOrchestrator(api_key=api_key)
+    return QueryOrchestrator(api_key=api_key, embed_func=embed_func)
 
 
 def test_orchestrator():
@@ -0,0 +1,201 @@
+"""
+Semantic response cache for the Streamlit chat.
+
+Repeated and near-repeated questions are answered from memory instead of
+rerunning routing, retrieval and COMPLETE. Lookups first try an exact match
+on the normalized question, then compare the question's embedding against
+every cached question with one matrix-vector product. Only answers stored
+with ``semantic=True`` take part in the near-duplicate comparison.
+"""
+
+import re
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Any, Callable, Hashable, Optional, Sequence, Tuple
+
+import numpy as np
+
+from local_ann import _as_vector
+from orchestrator import normalize_question
+from snowflake_connect import pooled_conn
+
+CACHE_MAX_ENTRIES = 512
+SIMILARITY_THRESHOLD = 0.95
+# Answers built from live query results (e.g. Cortex Analyst rows) go stale;
+# pass this as put(ttl=...) so they are re-run after a few minutes
+ANALYTICS_CACHE_TTL_SECONDS = 300
+_NUMBER_RE = re.compile(r"\d+(?:\.\d+)?")
+# Ranking and direction words that embeddings barely tell apart
+# ("top 5 customers" vs "bottom 5 customers")
+_DIRECTION_RE = re.compile(
+    r"\b(?:top|bottom|highest|lowest|largest|smallest|biggest|most|least|max(?:imum)?|min(?:imum)?"
+    r"|best|worst|first|last|more|less|fewer|above|below|before|after|increas\w*|decreas\w*"
+    r"|asc\w*|desc\w*)\b"
+)
+
+
+def _guard_terms(normalized_question: str) -> Tuple[list, frozenset]:
+    """Numbers and direction words that must match for a near-duplicate hit."""
+    return (
+        _NUMBER_RE.findall(normalized_question),
+        frozenset(_DIRECTION_RE.findall(normalized_question))
+    )
+
+
+@lru_cache(maxsize=1024)
+def embed_question(question: str) -> Tuple[float, ...]:
+    """Embed a question with the same Cortex model used for the document chunks."""
+    with pooled_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT SNOWFLAKE.CORTEX.EMBED_TEXT_768('e5-base-v2', %s)", (question,))
+            (vector,) = cur.fetchone()
+    return tuple(_as_vector(vector).tolist())
+
+
+class SemanticCache:
+    """
+    LRU cache of answers keyed on question embeddings.
+
+    A question hits when it matches a cached question exactly (after
+    normalization) or, for answers stored with ``semantic=True``, when their
+    embeddings' cosine similarity is at least ``threshold``. Near-duplicates
+    must also mention the same numbers and direction words, so "sales in 2023"
+    never reuses the answer for "sales in 2024", nor "bottom 5" the answer
+    for "top 5". Entries stored with a ``ttl`` expire after that many seconds.
+    """
+
+    def __init__(
+        self,
+        embed_func: Callable[[str], Sequence[float]] = embed_question,
+        max_entries: int = CACHE_MAX_ENTRIES,
+        threshold: float = SIMILARITY_THRESHOLD
+    ):
+        """
+        Args:
+            embed_func: Callable returning an embedding for a question
+            max_entries: Number of answers kept before evicting the least recently used
+            threshold: Minimum cosine similarity for a near-duplicate hit
+        """
+        self.embed_func = embed_func
+        self.max_entries = max_entries
+        self.threshold = threshold
+        # (normalized question, scope) -> (unit-norm embedding or None, value, expiry time or None)
+        self._entries: "OrderedDict[Tuple[str, Hashable], Tuple[Optional[np.ndarray], Any, Optional[float]]]" = OrderedDict()
+        self._matrix: Optional[np.ndarray] = None
+        self._matrix_keys: list = []
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, question: str, scope: Hashable = None) -> Optional[Any]:
+        """
+        Look up a cached answer.
+
+        Args:
+            question: User's question
+            scope: Extra key that must match exactly (e.g. the number of chunks k)
+
+        Returns:
+            The cached value, or None on a miss
+        """
+        key = (normalize_question(question), scope)
+        with self._lock:
+            if key in self._entries and not self._expire(key):
+                self._entries.move_to_end(key)
+                return self._entries[key][1]
+            # Without cached embeddings there is nothing to compare against,
+            # so skip the Snowflake embedding call
+            if self._similarity_matrix()[0] is None:
+                return None
+
+        vector = self._embed(question)
+        if vector is None:
+            return None
+
+        with self._lock:
+            matrix, keys = self._similarity_matrix()
+            if matrix is None:
+                return None
+            similarities = matrix @ vector
+            guard_terms = _guard_terms(key[0])
+            for i in np.argsort(-similarities):
+                if similarities[i] < self.threshold:
+                    break
+                cached_key = keys[i]
+                if cached_key[1] != scope or _guard_terms(cached_key[0]) != guard_terms:
+                    continue
+                if cached_key in self._entries and not self._expire(cached_key):
+                    self._entries.move_to_end(cached_key)
+                    return self._entries[cached_key][1]
+        return None
+
+    def put(
+        self,
+        question: str,
+        value: Any,
+        scope: Hashable = None,
+        semantic: bool = True,
+        ttl: Optional[float] = None
+    ) -> None:
+        """
+        Store an answer, evicting the least recently used entry when full.
+
+        Args:
+            question: User's question
+            value: Answer to cache
+            scope: Extra key that must match exactly (e.g. the number of chunks k)
+            semantic: Whether near-duplicate questions may reuse this answer;
+                when False only the exact (normalized) question hits
+            ttl: Seconds until the answer expires, or None to keep it until evicted
+        """
+        key = (normalize_question(question), scope)
+        vector = self._embed(question) if semantic else None
+        expires_at = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            self._entries[key] = (vector, value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._matrix = None
+
+    def clear(self) -> None:
+        """Drop every cached answer."""
+        with self._lock:
+            self._entries.clear()
+            self._matrix = None
+            self._matrix_keys = []
+
+    def _expire(self, key: Tuple[str, Hashable]) -> bool:
+        """Drop the entry if its TTL has passed; returns True when it was dropped."""
+        expires_at = self._entries[key][2]
+        if expires_at is None or time.time() < expires_at:
+            return False
+        del self._entries[key]
+        self._matrix = None
+        return True
+
+    def _embed(self, question: str) -> Optional[np.ndarray]:
+        """Return a unit-norm embedding for the question, or None if unavailable."""
+        try:
+            vector = np.asarray(self.embed_func(question), dtype=np.float32)
+        except Exception as e:
+            print(f"Embedding error: {e}")
+            return None
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else None
+
+    def _similarity_matrix(self) -> Tuple[Optional[np.ndarray], list]:
+        """Stack the cached embeddings, rebuilding only after the entries changed."""
+        if self._matrix is None:
+            keys = [key for key, (vector, _, _) in self._entries.items() if vector is not None]
+            self._matrix_keys = keys
+            self._matrix = (
+                np.stack([self._entries[key][0] for key in keys])
+                if keys else np.empty((0, 0), dtype=np.float32)
+            )
+        if not self._matrix_keys:
+            return None, []
+        return self._matrix, self._matrix_keys
@@ -1,77 +1,242 @@
+import io
+import json
+import re
 import sys
-from typing import List, Tuple
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, FrozenSet, List, Optional, Tuple
 
-from snowflake_connect import connect_snowflake
+from snowflake_connect import pooled_conn
+from cortex_common import COMPLETE_SQL, models_in_order, race_async_queries
+from local_ann import local_ann_enabled, search_local
 
+MODELS = ['llama3-8b', 'mistral-7b', 'mixtral-8x7b', 'snowflake-arctic']
+# Model that answered most recently; tried first on the next question
+_WORKING_MODEL: Optional[str] = None
 
-def retrieve_context(question: str, k: int = 5) -> List[Tuple[str, str, int, float]]:
-	with connect_snowflake() as conn, conn.cursor() as cur:
-		# Compute embedding inside SQL to preserve VECTOR type
-		query = (
-			"WITH q AS ("
-			" SELECT SNOWFLAKE.CORTEX.EMBED_TEXT_768('e5-base-v2', %s) AS qvec"
-			") "
-			"SELECT d.DOC_ID, d.FILENAME, d.CHUNK_INDEX, "
-			" VECTOR_COSINE_SIMILARITY(d.EMBEDDING, q.qvec) AS SIM, "
-			" d.CONTENT "
-			"FROM PDF_DOC_CHUNKS d, q "
-			"ORDER BY SIM DESC "
-			"LIMIT %s"
-		)
-		cur.execute(query, (question, k))
-		rows = cur.fetchall()
-		# Return (content, filename, chunk_index, similarity)
-		return [(r[4], r[1], r[2], r[3]) for r in rows]
+# Contexts more similar than this (Jaccard over word 5-grams) are treated as duplicates
+DEDUP_JACCARD_THRESHOLD = 0.7
+# Each context is trimmed to about this many characters at a sentence boundary
+CONTEXT_MAX_CHARS = 800
+SHINGLE_SIZE = 5
 
+# Recent retrieve_context() results, keyed on (normalized question, k)
+RETRIEVAL_CACHE_TTL_SECONDS = 600
+RETRIEVAL_CACHE_SIZE = 1024
+_RETRIEVAL_CACHE: "OrderedDict[Tuple[str, int], Tuple[float, List[Tuple[str, str, int, float]]]]" = OrderedDict()
+_RETRIEVAL_LOCK = threading.Lock()
 
-def build_prompt(question: str, contexts: List[Tuple[str, str, int, float]]) -> str:
-	# Build context block without chunk references - just the content
-	context_block = "\n\n".join(
-		ctx for ctx, _, _, _ in contexts
-	)
+_SENTENCE_END_RE = re.compile(r"(?<=[.!?])\s")
+
+PROMPT_HEADER = (
+	"You are a helpful assistant that answers questions based on the provided document context. "
+	"Provide a clear, detailed, and comprehensive answer to the user's question. "
+	"Use only the information from the context below. "
+	"If the answer is not in the context, politely say you don't have that information.\n\n"
+	"IMPORTANT INSTRUCTIONS:\n"
+	"- Do NOT mention chunks, chunk numbers, files, or any technical details in your answer\n"
+	"- Do NOT reference the context structure (e.g., 'in chunk [1]', 'according to file X')\n"
+	"- Provide a natural, flowing answer as if you're an expert on the topic\n"
+	"- Synthesize information from all relevant parts of the context\n"
+	"- Write in a clear, professional manner\n\n"
+	"Context from documents:\n"
+)
+
+
+def prompt_footer(question: str) -> str:
 	return (
-		"You are a helpful assistant that answers questions based on the provided document context. "
-		"Provide a clear, detailed, and comprehensive answer to the user's question. "
-		"Use only the information from the context below. "
-		"If the answer is not in the context, politely say you don't have that information.\n\n"
-		"IMPORTANT INSTRUCTIONS:\n"
-		"- Do NOT mention chunks, chunk numbers, files, or any technical details in your answer\n"
-		"- Do NOT reference the context structure (e.g., 'in chunk [1]', 'according to file X')\n"
-		"- Provide a natural, flowing answer as if you're an expert on the topic\n"
-		"- Synthesize information from all relevant parts of the context\n"
-		"- Write in a clear, professional manner\n\n"
-		f"Context from documents:\n{context_block}\n\n"
-		f"Question: {question}\n\n"
+		f"\n\nQuestion: {question}\n\n"
 		"Answer (provide a clear, detailed response without mentioning chunks or files):"
 	)
 
 
-def ask(question: str) -> None:
-	contexts = retrieve_context(question, k=5)
-	prompt = build_prompt(question, contexts)
+def _retrieve(cur: Any, question: str, k: int) -> List[Tuple[str, str, int, float]]:
+	# Compute embedding inside SQL to preserve VECTOR type
+	query = (
+		"WITH q AS ("
+		" SELECT SNOWFLAKE.CORTEX.EMBED_TEXT_768('e5-base-v2', %s) AS qvec"
+		") "
+		"SELECT d.DOC_ID, d.FILENAME, d.CHUNK_INDEX, "
+		" VECTOR_COSINE_SIMILARITY(d.EMBEDDING, q.qvec) AS SIM, "
+		" d.CONTENT "
+		"FROM PDF_DOC_CHUNKS d, q "
+		"ORDER BY SIM DESC "
+		"LIMIT %s"
+	)
+	cur.execute(query, (question, k))
+	rows = cur.fetchall()
+	# Return (content, filename, chunk_index, similarity)
+	return [(r[4], r[1], r[2], r[3]) for r in rows]
+
+
+def retrieve_context(question: str, k: int = 5) -> List[Tuple[str, str, int, float]]:
+	"""Return the k best chunks for the question, reusing recent results for repeats."""
+	key = (question.strip().lower(), k)
+	now = time.time()
+	with _RETRIEVAL_LOCK:
+		cached = _RETRIEVAL_CACHE.get(key)
+		if cached and now - cached[0] < RETRIEVAL_CACHE_TTL_SECONDS:
+			_RETRIEVAL_CACHE.move_to_end(key)
+			return list(cached[1])
+
+	with pooled_conn() as conn, conn.cursor() as cur:
+		if local_ann_enabled():
+			contexts = search_local(cur, question, k)
+		else:
+			contexts = _retrieve(cur, question, k)
+
+	with _RETRIEVAL_LOCK:
+		_RETRIEVAL_CACHE[key] = (now, contexts)
+		_RETRIEVAL_CACHE.move_to_end(key)
+		while len(_RETRIEVAL_CACHE) > RETRIEVAL_CACHE_SIZE:
+			_RETRIEVAL_CACHE.popitem(last=False)
+	return list(contexts)
+
+
+def clear_retrieval_cache() -> None:
+	"""Drop all cached retrieval results (e.g. after re-ingesting documents)."""
+	with _RETRIEVAL_LOCK:
+		_RETRIEVAL_CACHE.clear()
+
+
+def _shingles(text: str) -> FrozenSet[Tuple[str, ...]]:
+	words = text.lower().split()
+	if len(words) <= SHINGLE_SIZE:
+		return frozenset([tuple(words)])
+	return frozenset(tuple(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1))
+
 
-	with connect_snowflake() as conn, conn.cursor() as cur:
-		# Try multiple models in order of preference
-		models = ['llama3-8b', 'mistral-7b', 'mixtral-8x7b', 'snowflake-arctic']
+def _trim_to_sentence(text: str, max_chars: int = CONTEXT_MAX_CHARS) -> str:
+	"""Cut text to at most max_chars, ending on a sentence boundary where possible."""
+	if len(text) <= max_chars:
+		return text
+	kept = 0
+	for match in _SENTENCE_END_RE.finditer(text, 0, max_chars + 1):
+		kept = match.start()
+	return text[:kept] if kept else text[:max_chars]
+
+
+def dedupe_contexts(
+	contexts: List[Tuple[str, str, int, float]],
+	threshold: float = DEDUP_JACCARD_THRESHOLD,
+	max_chars: int = CONTEXT_MAX_CHARS,
+) -> List[Tuple[str, str, int, float]]:
+	"""
+	Drop near-duplicate contexts and trim the rest to shrink the prompt.
+
+	Contexts are expected best-first; a context is dropped when its Jaccard
+	similarity to an already kept one exceeds the threshold.
+	"""
+	kept: List[Tuple[str, str, int, float]] = []
+	kept_shingles: List[FrozenSet[Tuple[str, ...]]] = []
+	for ctx, fn, ci, sim in contexts:
+		shingles = _shingles(ctx)
+		if any(len(shingles & other) > threshold * len(shingles | other) for other in kept_shingles):
+			continue
+		kept.append((_trim_to_sentence(ctx, max_chars), fn, ci, sim))
+		kept_shingles.append(shingles)
+	return kept
+
+
+def build_prompt(question: str, contexts: List[Tuple[str, str, int, float]]) -> str:
+	contexts = dedupe_contexts(contexts)
+	# Write the context without chunk references - just the content - straight
+	# into one buffer instead of joining it and then concatenating again
+	buf = io.StringIO()
+	buf.write(PROMPT_HEADER)
+	for i, (ctx, _, _, _) in enumerate(contexts):
+		if i:
+			buf.write("\n\n")
+		buf.write(ctx)
+	buf.write(prompt_footer(question))
+	return buf.getvalue()
+
+
+# Number of preferred models whose fused queries run concurrently in ask()
+SPECULATIVE_MODELS = 2
+
+
+# Embeds, searches, assembles the prompt and runs COMPLETE in one statement.
+# Parameters: (question, k, model, prompt header, prompt footer)
+FUSED_QUERY = (
+	"WITH q AS ("
+	" SELECT SNOWFLAKE.CORTEX.EMBED_TEXT_768('e5-base-v2', %s) AS qvec"
+	"), top AS ("
+	" SELECT d.FILENAME, d.CHUNK_INDEX, d.CONTENT, "
+	"  VECTOR_COSINE_SIMILARITY(d.EMBEDDING, q.qvec) AS SIM "
+	" FROM PDF_DOC_CHUNKS d, q "
+	" ORDER BY SIM DESC "
+	" LIMIT %s"
+	"), p AS ("
+	" SELECT LISTAGG(CONTENT, '\\n\\n') WITHIN GROUP (ORDER BY SIM DESC) AS CTX, "
+	"  ARRAY_AGG(ARRAY_CONSTRUCT(FILENAME, CHUNK_INDEX, SIM)) WITHIN GROUP (ORDER BY SIM DESC) AS SOURCES "
+	" FROM top"
+	") "
+	"SELECT SNOWFLAKE.CORTEX.COMPLETE(%s, %s || COALESCE(p.CTX, '') || %s), p.SOURCES "
+	"FROM p"
+)
+
+
+def _read_fused(cur: Any) -> Optional[Tuple[str, List[Tuple[str, int, float]]]]:
+	row = cur.fetchone()
+	if not row or row[0] is None:
+		return None
+	answer, sources = row
+	# ARRAY columns arrive as JSON text
+	return answer, [tuple(src) for src in json.loads(sources or "[]")]
+
+
+def ask(question: str, k: int = 5) -> None:
+	global _WORKING_MODEL
+	models = models_in_order(MODELS, _WORKING_MODEL)
+	with pooled_conn() as conn:
 		answer = None
 		last_error = None
-		for model in models:
-			try:
-				cur.execute(
-					f"SELECT SNOWFLAKE.CORTEX.COMPLETE('{model}', %s)",
-					(prompt,),
-				)
-				(answer,) = cur.fetchone()
-				break
-			except Exception as e:
-				last_error = str(e)
-				continue
+		footer = prompt_footer(question)
+		fallback_models = models[SPECULATIVE_MODELS:]
+		# Speculatively run the fused query on the top models at once and keep
+		# the first answer, so a slow or failing model costs no extra wall time
+		try:
+			result, winner = race_async_queries(
+				conn,
+				[
+					(model, FUSED_QUERY, (question, k, model, PROMPT_HEADER, footer))
+					for model in models[:SPECULATIVE_MODELS]
+				],
+				_read_fused,
+			)
+			if result is not None:
+				answer, sources = result
+				_WORKING_MODEL = winner
+			else:
+				last_error = "no answer from the fused retrieval query"
+		except Exception as e:
+			# Async submission unavailable; the raced models never ran, so try them all
+			last_error = str(e)
+			fallback_models = models
+
+		if answer is None:
+			# Fall back to separate retrieval and the models not yet tried
+			with conn.cursor() as cur:
+				contexts = _retrieve(cur, question, k)
+				prompt = build_prompt(question, contexts)
+				sources = [(fn, ci, sim) for _ctx, fn, ci, sim in contexts]
+				for model in fallback_models:
+					try:
+						cur.execute(COMPLETE_SQL, (model, prompt))
+						(answer,) = cur.fetchone()
+						_WORKING_MODEL = model
+						break
+					except Exception as e:
+						last_error = str(e)
+						continue
 		if answer is None:
 			raise Exception(f"All models failed. Last error: {last_error}")
 
 	print(answer)
 	print("\n---\nSources:")
-	for i, (_ctx, fn, ci, sim) in enumerate(contexts, 1):
+	for i, (fn, ci, sim) in enumerate(sources, 1):
 		print(f"[{i}] file={fn}, chunk={ci}, score={sim:.4f}")
 
 
@@ -2,9 +2,18 @@
 Wrapper module for RAG queries
 """
 
-from typing import List, Tuple, Dict, Any
+import re
+from typing import Dict, Any
 from rag_query import retrieve_context, build_prompt
-from snowflake_connect import connect_snowflake
+from cortex_batching import COMPLETE_TIMEOUT_SECONDS, BatchingCompleter
+
+# Concurrent questions share COMPLETE statements; models in order of preference
+_COMPLETER = BatchingCompleter(models=['llama3-8b', 'mistral-7b', 'mixtral-8x7b', 'snowflake-arctic'])
+
+# Chunk/file references that slip into answers: "chunk [1]", "in chunk 2", "[3] (file: x.pdf)"
+_CLEANUP_RE = re.compile(r'(?:\bin\s+)?\bchunk\s*\[?\d+\]?|\[?\d+\]?\s*\(file:.*?\)|\(file:.*?\)', re.IGNORECASE)
+# Three or more line breaks (with blank lines between) collapse to one blank line
+_WS_RE = re.compile(r'\n\s*\n\s*\n+')
 
 
 def query_rag_wrapper(question: str, k: int = 5) -> Dict[str, Any]:
@@ -32,48 +41,25 @@ def query_rag_wrapper(question: str, k: int = 5) -> Dict[str, Any]:
         # Build prompt
         prompt = build_prompt(question, contexts)
         
-        # Get LLM response
-        with connect_snowflake() as conn, conn.cursor() as cur:
-            # Try multiple models in order of preference
-            models = ['llama3-8b', 'mistral-7b', 'mixtral-8x7b', 'snowflake-arctic']
-            answer = None
-            last_error = None
-            for model in models:
-                try:
-                    cur.execute(
-                        f"SELECT SNOWFLAKE.CORTEX.COMPLETE('{model}', %s)",
-                        (prompt,),
-                    )
-                    (answer,) = cur.fetchone()
-                    break
-                except Exception as e:
-                    last_error = str(e)
-                    continue
-            
-            if answer is None:
-                raise Exception(f"All models failed. Last error: {last_error}")
+        # Get LLM response (batched with any concurrent questions)
+        answer = _COMPLETER.complete(prompt).result(timeout=COMPLETE_TIMEOUT_SECONDS)
+        if answer is None:
+            raise Exception("Cortex returned no answer")
         
         # Clean up the answer - remove any chunk references that might have slipped through
-        import re
-        # Remove references like "chunk [1]", "in chunk 2", "chunk [3]", etc.
-        answer = re.sub(r'\bchunk\s*\[?\d+\]?', '', answer, flags=re.IGNORECASE)
-        answer = re.sub(r'\bin\s+chunk\s+\[?\d+\]?', '', answer, flags=re.IGNORECASE)
-        answer = re.sub(r'\[?\d+\]?\s*\(file:.*?\)', '', answer)
-        answer = re.sub(r'\(file:.*?\)', '', answer)
-        # Clean up extra spaces and newlines
-        answer = re.sub(r'\n\s*\n\s*\n+', '\n\n', answer)  # Multiple newlines to double
-        answer = answer.strip()
+        answer = _WS_RE.sub('\n\n', _CLEANUP_RE.sub('', answer)).strip()
         
         # Format sources
-        sources = []
-        for i, (ctx, fn, ci, sim) in enumerate(contexts, 1):
-            sources.append({
+        sources = [
+            {
                 "index": i,
                 "filename": fn,
                 "chunk_index": ci,
                 "similarity": float(sim),
                 "content": ctx[:200] + "..." if len(ctx) > 200 else ctx
-            })
+            }
+            for i, (ctx, fn, ci, sim) in enumerate(contexts, 1)
+        ]
         
         return {
             "system": "RAG",
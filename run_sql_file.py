@@ -1,47 +1,88 @@
+import csv
+import re
 import sys
-from typing import List
+from typing import Iterator
 
 from snowflake_connect import connect_snowflake
 
+# Rows fetched per round when printing the final result
+FETCH_BATCH_SIZE = 10000
+
 
 def read_sql_file(path: str) -> str:
 	with open(path, "r", encoding="utf-8") as f:
 		return f.read()
 
 
-def split_statements(sql_text: str) -> List[str]:
-	# naive split by semicolon; sufficient for simple statements in our file
-	parts = [stmt.strip() for stmt in sql_text.split(";")]
-	# Filter out empty strings and statements that are only comments/whitespace
-	filtered = []
-	for p in parts:
-		# Remove comments and check if there's actual SQL content
-		lines = [line.strip() for line in p.split("\n") if line.strip() and not line.strip().startswith("--")]
-		if lines:
-			filtered.append(p)
-	return filtered
+# Comments, quoted text ('...', "...", $$...$$) and statement-ending semicolons;
+# everything between matches is plain SQL
+_TOKEN_RE = re.compile(
+	r"(?P<comment>--[^\n]*|/\*.*?(?:\*/|\Z))"
+	r"|(?P<quoted>'(?:[^'\\]|\\.|\\\Z)*(?:'|\Z)|\"[^\"]*(?:\"|\Z)|\$\$.*?(?:\$\$|\Z))"
+	r"|;",
+	re.S,
+)
+_NON_SPACE_RE = re.compile(r"\S")
+
+
+def iter_statements(sql_text: str) -> Iterator[str]:
+	"""
+	Yield the statements of a SQL script in one pass.
+
+	Semicolons only end a statement outside comments and quoted text
+	('...', "...", $$...$$); statements consisting only of comments and
+	whitespace are skipped. Comments inside a statement are kept.
+	"""
+	start = 0
+	pos = 0
+	has_code = False
+	# The regex engine skips over plain SQL; Python only sees the tokens
+	for match in _TOKEN_RE.finditer(sql_text):
+		if not has_code and _NON_SPACE_RE.search(sql_text, pos, match.start()):
+			has_code = True
+		kind = match.lastgroup
+		if kind == "quoted":
+			has_code = True
+		elif kind is None:
+			if has_code:
+				yield sql_text[start:match.start()].strip()
+			start = match.end()
+			has_code = False
+		pos = match.end()
+	if has_code or _NON_SPACE_RE.search(sql_text, pos):
+		yield sql_text[start:].strip()
 
 
 def main() -> None:
 	sql_path = "sql/select_all_products.sql" if len(sys.argv) < 2 else sys.argv[1]
 	sql_text = read_sql_file(sql_path)
-	statements = split_statements(sql_text)
+	statements = list(iter_statements(sql_text))
 
 	with connect_snowflake() as conn:
 		with conn.cursor() as cur:
 			last_result = None
-			for stmt in statements:
-				cur.execute(stmt)
+			if len(statements) > 1:
+				# Send the whole script in one multi-statement request (one round trip
+				# instead of one per statement), then load only the last statement's result
+				cur.execute("\n;\n".join(statements), num_statements=len(statements))
+				cur.get_results_from_sfqid(cur.multi_statement_savedIds[-1])
+				last_result = cur
+			elif statements:
+				cur.execute(statements[0])
 				last_result = cur
 
 			if last_result is not None:
 				cols = [c[0] for c in last_result.description] if last_result.description else []
-				rows = last_result.fetchall() if last_result.description else []
 
 				if cols:
-					print(",".join(cols))
-					for r in rows:
-						print(",".join("" if v is None else str(v) for v in r))
+					# Stream rows in batches; csv.writer formats in C and writes None as ""
+					writer = csv.writer(sys.stdout, lineterminator="\n")
+					writer.writerow(cols)
+					while True:
+						rows = last_result.fetchmany(FETCH_BATCH_SIZE)
+						if not rows:
+							break
+						writer.writerows(rows)
 				else:
 					print("Statement executed successfully.")
 
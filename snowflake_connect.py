@@ -1,17 +1,41 @@
 import os
-from typing import Optional, Dict, Any
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Optional, Dict, Any, Iterator, Mapping, Set
 
 import snowflake.connector
 from dotenv import load_dotenv
 
 
+# .env paths already loaded in this process (None is the default lookup)
+_ENV_LOADED: Set[Optional[str]] = set()
+
+
 def load_environment(dotenv_path: Optional[str] = None) -> None:
-	"""Load environment variables from a .env file if present."""
+	"""Load environment variables from a .env file if present (once per path)."""
+	if dotenv_path in _ENV_LOADED:
+		return
 	load_dotenv(dotenv_path=dotenv_path)
+	_ENV_LOADED.add(dotenv_path)
 
 
-def get_snowflake_connection_params() -> Dict[str, Any]:
-	"""Collect Snowflake connection parameters from environment variables."""
+@lru_cache(maxsize=8)
+def get_snowflake_connection_params(dotenv_path: Optional[str] = None) -> Mapping[str, Any]:
+	"""
+	Collect Snowflake connection parameters from environment variables.
+
+	As with load_dotenv, variables already set in the process environment take
+	precedence over the .env file. The result is computed once per dotenv_path
+	and returned as a read-only mapping shared by all callers; call
+	get_snowflake_connection_params.cache_clear() after changing the environment.
+	Missing variables raise ValueError and are not cached.
+	"""
+	load_environment(dotenv_path=dotenv_path)
+
 	account = os.getenv("SNOWFLAKE_ACCOUNT")
 	user = os.getenv("SNOWFLAKE_USER")
 	password = os.getenv("SNOWFLAKE_PASSWORD")
@@ -43,16 +67,131 @@ def get_snowflake_connection_params() -> Dict[str, Any]:
 		"database": database,
 		"schema": schema,
 	}
-	return params
+	return MappingProxyType(params)
 
 
 def connect_snowflake(dotenv_path: Optional[str] = None) -> snowflake.connector.SnowflakeConnection:
 	"""Create and return a Snowflake connection using env vars."""
-	load_environment(dotenv_path=dotenv_path)
-	params = get_snowflake_connection_params()
+	params = get_snowflake_connection_params(dotenv_path)
 	return snowflake.connector.connect(**params)
 
 
+POOL_MAX_SIZE = 8
+# How long pooled_conn() waits for a connection when all POOL_MAX_SIZE are lent out
+POOL_WAIT_SECONDS = 60
+HEARTBEAT_INTERVAL_SECONDS = 240
+
+# Idle connections shared by pooled_conn() callers in this process
+_IDLE: "deque[snowflake.connector.SnowflakeConnection]" = deque()
+_POOL_LOCK = threading.Lock()
+# Notified whenever a connection is returned or a pool slot frees up
+_POOL_CHANGED = threading.Condition(_POOL_LOCK)
+_pool_size = 0
+_heartbeat: Optional[threading.Thread] = None
+_heartbeat_stop = threading.Event()
+
+
+def _release_slot() -> None:
+	"""Give up a pool slot and wake a caller waiting for one."""
+	global _pool_size
+	with _POOL_CHANGED:
+		_pool_size -= 1
+		_POOL_CHANGED.notify()
+
+
+def _discard_conn(conn: snowflake.connector.SnowflakeConnection) -> None:
+	try:
+		conn.close()
+	except Exception:
+		pass
+	_release_slot()
+
+
+def _get_conn() -> snowflake.connector.SnowflakeConnection:
+	"""
+	Take an idle pooled connection, opening a new one while under POOL_MAX_SIZE.
+
+	Raises TimeoutError if the pool is exhausted for POOL_WAIT_SECONDS.
+	"""
+	global _pool_size
+	deadline = time.monotonic() + POOL_WAIT_SECONDS
+	while True:
+		with _POOL_CHANGED:
+			while not _IDLE and _pool_size >= POOL_MAX_SIZE:
+				remaining = deadline - time.monotonic()
+				if remaining <= 0:
+					raise TimeoutError(
+						f"No Snowflake connection became available within {POOL_WAIT_SECONDS}s "
+						f"({POOL_MAX_SIZE} connections in use)"
+					)
+				_POOL_CHANGED.wait(remaining)
+			if _IDLE:
+				conn = _IDLE.popleft()
+			else:
+				conn = None
+				_pool_size += 1
+		if conn is None:
+			_start_heartbeat()
+			try:
+				return connect_snowflake()
+			except Exception:
+				_release_slot()
+				raise
+		if not conn.is_closed():
+			return conn
+		_discard_conn(conn)
+
+
+def _put_conn(conn: snowflake.connector.SnowflakeConnection) -> None:
+	"""Return a connection to the pool, dropping it if it has been closed."""
+	if conn.is_closed():
+		_discard_conn(conn)
+		return
+	with _POOL_CHANGED:
+		_IDLE.append(conn)
+		_POOL_CHANGED.notify()
+
+
+@contextmanager
+def pooled_conn() -> Iterator[snowflake.connector.SnowflakeConnection]:
+	"""Borrow a Snowflake connection from the process-wide pool."""
+	conn = _get_conn()
+	try:
+		yield conn
+	finally:
+		_put_conn(conn)
+
+
+def _heartbeat_loop() -> None:
+	"""Ping idle pooled connections so Snowflake does not drop them."""
+	while not _heartbeat_stop.wait(HEARTBEAT_INTERVAL_SECONDS):
+		for _ in range(len(_IDLE)):
+			with _POOL_LOCK:
+				if not _IDLE:
+					break
+				conn = _IDLE.popleft()
+			try:
+				with conn.cursor() as cur:
+					cur.execute("SELECT 1")
+			except Exception:
+				_discard_conn(conn)
+			else:
+				_put_conn(conn)
+
+
+def stop_heartbeat() -> None:
+	"""Stop the heartbeat thread after its current round."""
+	_heartbeat_stop.set()
+
+
+def _start_heartbeat() -> None:
+	global _heartbeat
+	with _POOL_LOCK:
+		if _heartbeat is None:
+			_heartbeat = threading.Thread(target=_heartbeat_loop, name="snowflake-heartbeat", daemon=True)
+			_heartbeat.start()
+
+
 def test_connection(dotenv_path: Optional[str] = None) -> str:
 	"""Run a simple query to verify the connection and return the Snowflake version."""
 	with connect_snowflake(dotenv_path=dotenv_path) as conn:
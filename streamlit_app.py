@@ -1,8 +1,9 @@
 import streamlit as st
+import pandas as pd
 from typing import List, Tuple, Dict, Any
 import sys
 import os
-from dotenv import load_dotenv
+from dotenv import dotenv_values, load_dotenv
 
 # Get the directory where this script is located
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -12,21 +13,11 @@ ENV_PATH = os.path.join(SCRIPT_DIR, '.env')
 if os.path.exists(ENV_PATH):
     load_dotenv(dotenv_path=ENV_PATH, override=True)
     
-    # Workaround: Manually read .env file if SNOWFLAKE_ACCOUNT is not loaded
-    if not os.getenv('SNOWFLAKE_ACCOUNT'):
-        try:
-            with open(ENV_PATH, 'r', encoding='utf-8') as f:
-                for line in f:
-                    line = line.strip()
-                    if line and not line.startswith('#') and '=' in line:
-                        key, value = line.split('=', 1)
-                        key = key.strip()
-                        value = value.strip().strip('"').strip("'")
-                        if key == 'SNOWFLAKE_ACCOUNT' and value:
-                            os.environ[key] = value
-                            break
-        except Exception as e:
-            print(f"Warning: Could not manually load SNOWFLAKE_ACCOUNT: {e}")
+    # Fill in anything load_dotenv missed, such as the first key of a file
+    # saved with a UTF-8 byte order mark
+    for key, value in dotenv_values(ENV_PATH, encoding="utf-8-sig").items():
+        if value and not os.getenv(key):
+            os.environ[key] = value
 else:
     # Fallback to default .env lookup
     load_dotenv(override=True)
@@ -34,10 +25,9 @@ else:
 # Add the current directory to the path to import local modules
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
-from snowflake_connect import connect_snowflake
+from snowflake_connect import pooled_conn
 from orchestrator import create_orchestrator
-from cortex_analyst_wrapper import query_cortex_analyst_wrapper
-from rag_wrapper import query_rag_wrapper
+from rag_cache import ANALYTICS_CACHE_TTL_SECONDS, SemanticCache, embed_question
 
 # Page configuration
 st.set_page_config(
@@ -48,7 +38,7 @@ st.set_page_config(
 )
 
 # Custom CSS for better styling
-st.markdown("""
+CUSTOM_CSS = """
     <style>
     .main-header {
         font-size: 2.5rem;
@@ -85,7 +75,20 @@ st.markdown("""
         font-size: 1.1rem;
     }
     </style>
-    """, unsafe_allow_html=True)
+    """
+st.markdown(CUSTOM_CSS, unsafe_allow_html=True)
+
+
+def preview_text(text: str, limit: int = 200) -> str:
+    """Shorten source text for display in the sources expander."""
+    return text[:limit] + "..." if len(text) > limit else text
+
+
+@st.cache_resource
+def get_response_cache() -> SemanticCache:
+    """Share one semantic answer cache across reruns and sessions."""
+    return SemanticCache()
+
 
 # Initialize session state
 if "messages" not in st.session_state:
@@ -95,7 +98,20 @@ if "sources" not in st.session_state:
     st.session_state.sources = []
 
 if "orchestrator" not in st.session_state:
-    st.session_state.orchestrator = create_orchestrator()
+    # Near-duplicate questions reuse routes via the same Cortex embeddings as the answer cache
+    st.session_state.orchestrator = create_orchestrator(embed_func=embed_question)
+
+
+# The wrappers are imported on first use, so a session that only asks document
+# questions never loads the analytics stack (and vice versa)
+def run_cortex_analyst(question: str) -> Dict[str, Any]:
+    from cortex_analyst_wrapper import query_cortex_analyst_wrapper
+    return query_cortex_analyst_wrapper(question)
+
+
+def run_rag(question: str, k: int = 5) -> Dict[str, Any]:
+    from rag_wrapper import query_rag_wrapper
+    return query_rag_wrapper(question, k=k)
 
 
 def get_orchestrated_response(question: str, k: int = 5) -> Dict[str, Any]:
@@ -106,16 +122,31 @@ def get_orchestrated_response(question: str, k: int = 5) -> Dict[str, Any]:
         Dictionary with routing info, results, and combined response
     """
     try:
+        # Repeated and near-duplicate questions are answered from the cache
+        cache = get_response_cache()
+        cached = cache.get(question, scope=k)
+        if cached is not None:
+            return cached
+        
         orchestrator = st.session_state.orchestrator
         
         # Execute the query through orchestrator
         result = orchestrator.execute_query(
             question=question,
-            cortex_analyst_func=query_cortex_analyst_wrapper,
-            rag_query_func=lambda q: query_rag_wrapper(q, k=k),
+            cortex_analyst_func=run_cortex_analyst,
+            rag_query_func=lambda q: run_rag(q, k=k),
             k=k
         )
         
+        # Failed lookups are retried next time rather than replayed. Analytics
+        # rows are reused only for the exact question, and only briefly, since
+        # near-duplicates ("top 5" vs "bottom 5") need different SQL
+        results = result.get("results", {})
+        if not any("error" in r for r in results.values()):
+            if "cortex_analyst" in results:
+                cache.put(question, result, scope=k, semantic=False, ttl=ANALYTICS_CACHE_TTL_SECONDS)
+            else:
+                cache.put(question, result, scope=k)
         return result
     
     except Exception as e:
@@ -135,10 +166,12 @@ def get_orchestrated_response(question: str, k: int = 5) -> Dict[str, Any]:
 with st.sidebar:
     st.title("⚙️ Settings")
     
-    # Connection status
+    # Connection status, checked on the shared pool the queries use: a
+    # connection is only opened when none is idle, so reruns cost no round trip
     try:
-        with connect_snowflake() as conn:
-            st.success("✅ Connected to Snowflake")
+        with pooled_conn():
+            pass
+        st.success("✅ Connected to Snowflake")
     except ValueError as e:
         error_msg = str(e)
         st.error(f"❌ Configuration Error: {error_msg}")
@@ -211,7 +244,7 @@ for message in st.session_state.messages:
                 for i, source in enumerate(message["sources"], 1):
                     if isinstance(source, dict):
                         st.markdown(f"**Source {i}:** `{source.get('filename', 'Unknown')}` (Chunk {source.get('chunk_index', 'N/A')}, Similarity: {source.get('similarity', 0):.4f})")
-                        st.markdown(f"*{source.get('content_preview', '')}*")
+                        st.markdown(f"*{source.get('preview', '')}*")
                     else:
                         # Legacy format
                         ctx, fn, ci, sim = source
@@ -228,8 +261,10 @@ for message in st.session_state.messages:
                     st.code(analytics["sql_query"], language="sql")
                 if "results" in analytics and analytics["results"]:
                     st.markdown(f"**Results ({analytics.get('row_count', 0)} rows):**")
-                    import pandas as pd
-                    df = pd.DataFrame(analytics["results"])
+                    # Built once when the message was added, not on every rerun
+                    df = message.get("analytics_df")
+                    if df is None:
+                        df = pd.DataFrame(analytics["results"])
                     st.dataframe(df, use_container_width=True)
 
 # Chat input
@@ -252,11 +287,19 @@ if prompt := st.chat_input("Ask a question (analytics, documents, or both)..."):
             rag_results = result.get("results", {}).get("rag", {})
             cortex_results = result.get("results", {}).get("cortex_analyst", {})
             
-            # Display sources if RAG was used
-            sources = rag_results.get("sources", []) if rag_results else []
+            # Display sources if RAG was used; previews are cut once here rather
+            # than on every rerun of the history loop
+            sources = [
+                dict(source, preview=preview_text(source.get("content", "")))
+                for source in (rag_results.get("sources", []) if rag_results else [])
+            ]
             
             # Display analytics results if Cortex Analyst was used
             analytics_results = cortex_results if cortex_results and "error" not in cortex_results else None
+            analytics_df = (
+                pd.DataFrame(analytics_results["results"])
+                if analytics_results and analytics_results.get("results") else None
+            )
     
     # Add assistant message to chat history
     st.session_state.messages.append({
@@ -264,7 +307,8 @@ if prompt := st.chat_input("Ask a question (analytics, documents, or both)..."):
         "content": result.get("combined_response", "No response"),
         "routing_info": routing_info,
         "sources": sources,
-        "analytics_results": analytics_results
+        "analytics_results": analytics_results,
+        "analytics_df": analytics_df
     })
 
 # Footer
@@ -2,6 +2,8 @@
 Test script for the complete integration
 """
 
+from concurrent.futures import ThreadPoolExecutor
+
 from orchestrator import create_orchestrator
 from cortex_analyst_wrapper import query_cortex_analyst_wrapper
 from rag_wrapper import query_rag_wrapper
@@ -20,29 +22,37 @@ def test_integration():
         "Show me all products in the database"
     ]
     
-    for query in test_queries:
-        print(f"\n{'='*70}")
-        print(f"Query: {query}")
-        print(f"{'='*70}\n")
+    def run(query):
+        return orchestrator.execute_query(
+            question=query,
+            cortex_analyst_func=query_cortex_analyst_wrapper,
+            rag_query_func=query_rag_wrapper,
+            k=5
+        )
+    
+    # The queries are network-bound, so run them concurrently; the wrappers
+    # share the pooled Snowflake connections. Results print in query order.
+    with ThreadPoolExecutor(max_workers=len(test_queries)) as executor:
+        futures = [executor.submit(run, query) for query in test_queries]
         
-        try:
-            result = orchestrator.execute_query(
-                question=query,
-                cortex_analyst_func=query_cortex_analyst_wrapper,
-                rag_query_func=query_rag_wrapper,
-                k=5
-            )
-            
-            print(f"Route: {result['classification']['route']}")
-            print(f"Query Type: {result['classification']['query_type']}")
-            print(f"Confidence: {result['classification']['confidence']:.2f}")
-            print(f"\nReasoning: {result['classification']['reasoning']}")
-            print(f"\nResponse Preview:\n{result['combined_response'][:200]}...")
+        for query, future in zip(test_queries, futures):
+            print(f"\n{'='*70}")
+            print(f"Query: {query}")
+            print(f"{'='*70}\n")
             
-        except Exception as e:
-            print(f"Error: {e}")
-            import traceback
-            traceback.print_exc()
+            try:
+                result = future.result()
+                
+                print(f"Route: {result['classification']['route']}")
+                print(f"Query Type: {result['classification']['query_type']}")
+                print(f"Confidence: {result['classification']['confidence']:.2f}")
+                print(f"\nReasoning: {result['classification']['reasoning']}")
+                print(f"\nResponse Preview:\n{result['combined_response'][:200]}...")
+                
+            except Exception as e:
+                print(f"Error: {e}")
+                import traceback
+                traceback.print_exc()
 
 if __name__ == "__main__":
     test_integration()
@@ -2,6 +2,8 @@
 Test script for the orchestrator integration
 """
 
+from concurrent.futures import ThreadPoolExecutor
+
 from orchestrator import create_orchestrator
 from cortex_analyst_wrapper import query_cortex_analyst_wrapper
 from rag_wrapper import query_rag_wrapper
@@ -21,27 +23,35 @@ def main():
         "How do our sales compare to what's mentioned in the reports?"  # Hybrid
     ]
     
-    for i, query in enumerate(test_queries, 1):
-        print(f"\n{'='*70}")
-        print(f"Test {i}: {query}")
-        print(f"{'='*70}\n")
+    def run(query):
+        return orchestrator.execute_query(
+            question=query,
+            cortex_analyst_func=query_cortex_analyst_wrapper,
+            rag_query_func=lambda q: query_rag_wrapper(q, k=5),
+            k=5
+        )
+    
+    # Run the network-bound queries concurrently; results print in query order
+    with ThreadPoolExecutor(max_workers=len(test_queries)) as executor:
+        futures = [executor.submit(run, query) for query in test_queries]
         
-        try:
-            result = orchestrator.route_query(
-                user_query=query,
-                cortex_analyst_func=query_cortex_analyst_wrapper,
-                rag_query_func=lambda q: query_rag_wrapper(q, k=5)
-            )
-            
-            print(f"Query Type: {result['classification']['query_type']}")
-            print(f"Confidence: {result['classification']['confidence']:.2f}")
-            print(f"Reasoning: {result['classification']['reasoning']}")
-            print(f"\nResponse Preview: {result['combined_response'][:200]}...")
+        for i, (query, future) in enumerate(zip(test_queries, futures), 1):
+            print(f"\n{'='*70}")
+            print(f"Test {i}: {query}")
+            print(f"{'='*70}\n")
             
-        except Exception as e:
-            print(f"Error: {e}")
-            import traceback
-            traceback.print_exc()
+            try:
+                result = future.result()
+                
+                print(f"Query Type: {result['classification']['query_type']}")
+                print(f"Confidence: {result['classification']['confidence']:.2f}")
+                print(f"Reasoning: {result['classification']['reasoning']}")
+                print(f"\nResponse Preview: {result['combined_response'][:200]}...")
+                
+            except Exception as e:
+                print(f"Error: {e}")
+                import traceback
+                traceback.print_exc()
 
 if __name__ == "__main__":
     main()